@@ -1,9 +1,10 @@
 from flask import Flask, g, request, jsonify
 from dotenv import load_dotenv
 from functools import wraps
-from sqlalchemy import select
-from app.database import engine
-from app.db.models import Project
+from app.utils.auth_cache import get_project_id
+from app.utils.rate_limit import check_rate_limit
+from app.database import mark_write
+from app.metrics import init_metrics, phase
 from flask_cors import CORS
 import os
 from flask import Blueprint
@@ -32,10 +33,14 @@ def create_app():
                  "http://127.0.0.1:3000"
              ],
              "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-             "allow_headers": ["Content-Type", "Authorization"],
+             "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key"],
              "supports_credentials": True
          }},
-         expose_headers=["Content-Type", "Authorization"])
+         expose_headers=["Content-Type", "Authorization", "Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining",
+                         "X-Next-After", "Idempotent-Replayed"])
+
+    # Request and phase timing, exposed on /metrics
+    init_metrics(app)
 
     # Register blueprints
     from app.api import devices, messages, admin
@@ -51,8 +56,8 @@ def create_app():
 
             return
 
-        # Skip authentication for admin routes
-        if request.path.startswith('/admin'):
+        # Skip authentication for admin routes and metrics
+        if request.path.startswith('/admin') or request.path == '/metrics':
             return
 
         # Get API key from Authorization header
@@ -62,17 +67,31 @@ def create_app():
 
         api_key = auth_header.split(' ')[1]
 
-        # Look up project by API key
-        with engine.connect() as conn:
-            project = conn.execute(
-                select(Project).where(Project.api_key == api_key)
-            ).first()
+        # Look up project by API key (cached)
+        with phase('auth'):
+            project_id = get_project_id(api_key)
+        if not project_id:
+            return jsonify({"error": "Invalid API key"}), 401
+
+        # Store project ID in g for use in routes
+        g.project_id = project_id
+
+        # Per-project, per-endpoint token bucket
+        allowed, g.rate_limit_headers = check_rate_limit(project_id, request.endpoint)
+        if not allowed:
+            return jsonify({"error": "Rate limit exceeded"}), 429, g.rate_limit_headers
 
-            if not project:
-                return jsonify({"error": "Invalid API key"}), 401
+    @app.after_request
+    def add_rate_limit_headers(response):
+        response.headers.update(g.get('rate_limit_headers', {}))
+        return response
 
-            # Store project ID in g for use in routes
-            g.project_id = project.id
+    @app.after_request
+    def read_your_writes(response):
+        # Successful writes pin the project's reads to the primary for a moment
+        if request.method in ('POST', 'PUT', 'DELETE') and 'project_id' in g and response.status_code < 400:
+            mark_write(g.project_id)
+        return response
     
     def require_admin(f):
         @wraps(f)
@@ -3,6 +3,8 @@ from functools import wraps
 from sqlalchemy import select
 from app.database import engine
 from app.db.models import Project
+from app.utils.auth_cache import invalidate_api_key
+from app.utils.rate_limit import set_rate_limits
 import os
 import secrets
 from cryptography.fernet import Fernet
@@ -49,6 +51,8 @@ def create_project():
         )
         conn.execute(Project.__table__.insert(), project.__dict__)
         conn.commit()
+        # Clear any cached "invalid key" entry for this key
+        invalidate_api_key(api_key)
         return jsonify({
             'id': project.id,
             'name': project.name,
@@ -92,4 +96,49 @@ def set_project_credentials(project_id):
             return jsonify({'error': 'Project not found'}), 404
         conn.execute(Project.__table__.update().where(Project.id == project_id).values(**updates))
         conn.commit()
-    return jsonify({'status': 'success', 'updated_fields': list(updates.keys())}), 200 
\ No newline at end of file
+        invalidate_api_key(project.api_key)
+    return jsonify({'status': 'success', 'updated_fields': list(updates.keys())}), 200
+
+@bp.route('/projects/<project_id>', methods=['PUT'])
+@require_admin
+def update_project(project_id):
+    data = request.get_json()
+    allowed_fields = ['name', 'message_retention_days']
+    updates = {field: data[field] for field in allowed_fields if field in data}
+    if not updates:
+        return jsonify({'error': 'No valid project fields provided'}), 400
+    retention_days = updates.get('message_retention_days')
+    if retention_days is not None and (
+        not isinstance(retention_days, int) or isinstance(retention_days, bool) or retention_days < 1
+    ):
+        return jsonify({'error': 'message_retention_days must be a positive integer'}), 400
+    with engine.connect() as conn:
+        project = conn.execute(select(Project).where(Project.id == project_id)).first()
+        if not project:
+            return jsonify({'error': 'Project not found'}), 404
+        conn.execute(Project.__table__.update().where(Project.id == project_id).values(**updates))
+        conn.commit()
+    return jsonify({'status': 'success', 'updated_fields': list(updates.keys())}), 200
+
+@bp.route('/projects/<project_id>/rate_limits', methods=['PUT'])
+@require_admin
+def set_project_rate_limits(project_id):
+    """Replace a project's per-endpoint limits, e.g. {"messages.send_message": {"rate": 10, "burst": 20}}"""
+    limits = request.get_json()
+    if not isinstance(limits, dict):
+        return jsonify({'error': 'Rate limits must be an object keyed by endpoint'}), 400
+    for endpoint, limit in limits.items():
+        if (
+            not isinstance(limit, dict)
+            or not isinstance(limit.get('rate'), (int, float)) or limit['rate'] < 0
+            or not isinstance(limit.get('burst'), int) or limit['burst'] < 1
+        ):
+            return jsonify({'error': f'Invalid limit for {endpoint}: rate must be >= 0 and burst >= 1'}), 400
+    with engine.connect() as conn:
+        project = conn.execute(select(Project).where(Project.id == project_id)).first()
+        if not project:
+            return jsonify({'error': 'Project not found'}), 404
+        conn.execute(Project.__table__.update().where(Project.id == project_id).values(rate_limits=limits))
+        conn.commit()
+    set_rate_limits(project_id, limits)
+    return jsonify({'status': 'success', 'rate_limits': limits}), 200
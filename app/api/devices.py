@@ -1,17 +1,84 @@
 import traceback
-from flask import Blueprint, jsonify, request, g
-from sqlalchemy import select, and_
-from app.database import engine
+from flask import Blueprint, Response, current_app, jsonify, request, g, stream_with_context
+from sqlalchemy import select, and_, func, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from app.database import engine, read_connection
 from app.db.models import Device
+from app.topics import subscribe, unsubscribe
 from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import json
+import os
+
+DEVICE_BATCH_CHUNK_SIZE = int(os.environ.get('DEVICE_BATCH_CHUNK_SIZE', 1000))
+DEVICE_BATCH_MAX_SIZE = int(os.environ.get('DEVICE_BATCH_MAX_SIZE', 10000))
+DEVICE_STREAM_BATCH_SIZE = int(os.environ.get('DEVICE_STREAM_BATCH_SIZE', 1000))
+DEVICE_LIST_MAX_LIMIT = int(os.environ.get('DEVICE_LIST_MAX_LIMIT', 10000))
 
 bp = Blueprint('devices', __name__, url_prefix='/devices')
 
+def upsert_devices(rows):
+    """
+    Multi-row INSERT ... ON CONFLICT DO UPDATE on (project_id, platform, token).
+    An existing device keeps its user_id and timezone unless new ones are given, adds any
+    new topics to its existing ones, and a re-registered dead token is revived.
+    """
+    stmt = insert(Device).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=['project_id', 'platform', 'token'],
+        set_={
+            'user_id': func.coalesce(stmt.excluded.user_id, Device.user_id),
+            'timezone': func.coalesce(stmt.excluded.timezone, Device.timezone),
+            'topics': literal_column(
+                "ARRAY(SELECT DISTINCT unnest(coalesce(devices.topics, '{}') || coalesce(excluded.topics, '{}')))"
+            ),
+            'invalidated_at': None
+        }
+    ).returning(Device)
+
+def valid_topics(topics):
+    return topics is None or (isinstance(topics, list) and all(isinstance(topic, str) for topic in topics))
+
+def valid_timezone(name):
+    if name is None:
+        return True
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return False
+
+def device_list_query(project_id, args, after=None, limit=None):
+    """Build the GET /devices query: optional filters, keyset paged on id"""
+    query = select(Device).where(Device.project_id == project_id).order_by(Device.id)
+
+    # Add user_id filter if provided
+    if args.get('user_id'):
+        query = query.where(Device.user_id == args['user_id'])
+
+    # Add platform filter if provided
+    if args.get('platform'):
+        query = query.where(Device.platform == args['platform'])
+
+    # Keyset pagination on id
+    if after is not None:
+        query = query.where(Device.id > after)
+    if limit:
+        query = query.limit(limit)
+
+    return query
+
+def format_device(device):
+    """Convert a device row to a dict, parsing web push tokens back to JSON"""
+    device_dict = device._asdict()
+    if device_dict['platform'] == 'web':
+        device_dict['token'] = json.loads(device_dict['token'])
+    return device_dict
+
 @bp.route('/<id>', methods=['GET'])
 def list_devices(id):
     try:
-        with engine.connect() as conn:
+        with read_connection(g.project_id) as conn:
             device = conn.execute(
                 select(Device).where(
                     Device.id == id,
@@ -33,100 +100,121 @@ def register_device():
         for field in required_fields:
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
+        if not valid_topics(data.get('topics')):
+            return jsonify({"error": "topics must be a list of strings"}), 400
+        if not valid_timezone(data.get('timezone')):
+            return jsonify({"error": "timezone must be an IANA timezone name"}), 400
         
         # For web push, ensure token is stored as JSON string
         if data['platform'] == 'web':
             data['token'] = json.dumps(data['token'])
         
-        # Create device record
+        # Insert or update the device in a single statement
         with engine.connect() as conn:
-            # Check if device exists
-            existing_device = conn.execute(
-                select(Device).where(
-                    and_(
-                        Device.token == data['token'],
-                        Device.platform == data['platform'],
-                        Device.project_id == g.project_id
-                    )
-                )
-            ).first()
-            
-            if existing_device:
-                # If device exists, update user_id if provided
-                if data.get('user_id') and data['user_id'] != existing_device.user_id:
-                    result = conn.execute(
-                        Device.__table__.update()
-                        .where(
-                            and_(
-                                Device.token == data['token'],
-                                Device.platform == data['platform'],
-                                Device.project_id == g.project_id
-                            )
-                        )
-                        .values(
-                            user_id=data['user_id']
-                        )
-                        .returning(Device)
-                    )
-                    device = result.first()
-                else:
-                    device = existing_device
-            else:
-                # Insert new device
-                device = Device(
-                    project_id=g.project_id,
-                    user_id=data.get('user_id'),
-                    platform=data['platform'],
-                    token=data['token']
-                )
-                result = conn.execute(Device.__table__.insert().returning(Device), device.__dict__)
-                device = result.first()
-            
+            device = conn.execute(upsert_devices([{
+                'project_id': g.project_id,
+                'user_id': data.get('user_id'),
+                'platform': data['platform'],
+                'token': data['token'],
+                'topics': data.get('topics'),
+                'timezone': data.get('timezone')
+            }])).first()
             conn.commit()
             
             if not device:
                 return jsonify({"error": "Failed to create/update device"}), 500
+
+            # Mirror topic membership in Redis
+            subscribe(g.project_id, [(device.id, device.topics)])
             
             # For web push, parse the token back to JSON
-            device_dict = device._asdict()
-            if device_dict['platform'] == 'web':
-                device_dict['token'] = json.loads(device_dict['token'])
-            
-            return jsonify(device_dict), 200
+            return jsonify(format_device(device)), 200
             
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@bp.route('/batch', methods=['PUT'])
+def register_devices_batch():
+    try:
+        data = request.get_json()
+        devices = data.get('devices') if isinstance(data, dict) else None
+        if not isinstance(devices, list):
+            return jsonify({"error": "Missing required field: devices"}), 400
+        if len(devices) > DEVICE_BATCH_MAX_SIZE:
+            return jsonify({"error": f"At most {DEVICE_BATCH_MAX_SIZE} devices per batch"}), 400
+
+        # Validate and dedupe on (platform, token), the last entry wins
+        rows = {}
+        for index, device in enumerate(devices):
+            for field in ['platform', 'token']:
+                if field not in device:
+                    return jsonify({"error": f"Missing required field: {field} (device {index})"}), 400
+            if not valid_topics(device.get('topics')):
+                return jsonify({"error": f"topics must be a list of strings (device {index})"}), 400
+            if not valid_timezone(device.get('timezone')):
+                return jsonify({"error": f"timezone must be an IANA timezone name (device {index})"}), 400
+            token = json.dumps(device['token']) if device['platform'] == 'web' else device['token']
+            rows[(device['platform'], token)] = {
+                'project_id': g.project_id,
+                'user_id': device.get('user_id'),
+                'platform': device['platform'],
+                'token': token,
+                'topics': device.get('topics'),
+                'timezone': device.get('timezone')
+            }
+        rows = list(rows.values())
+
+        # Upsert in multi-row chunks within one transaction
+        subscriptions = []
+        with engine.connect() as conn:
+            for start in range(0, len(rows), DEVICE_BATCH_CHUNK_SIZE):
+                upserted = conn.execute(upsert_devices(rows[start:start + DEVICE_BATCH_CHUNK_SIZE]))
+                subscriptions.extend((device.id, device.topics) for device in upserted if device.topics)
+            conn.commit()
+
+        # Mirror topic membership in Redis
+        subscribe(g.project_id, subscriptions)
+
+        return jsonify({'upserted': len(rows)}), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+def stream_devices(query):
+    """Yield devices as NDJSON lines from a server-side cursor"""
+    with read_connection(g.project_id) as conn:
+        result = conn.execution_options(yield_per=DEVICE_STREAM_BATCH_SIZE).execute(query)
+        for device in result:
+            yield current_app.json.dumps(format_device(device)) + '\n'
+
 @bp.route('/', methods=['GET'])
 def get_devices():
     try:
-        with engine.connect() as conn:
-            # Build query with optional filters
-            query = select(Device).where(Device.project_id == g.project_id)
-            
-            # Add user_id filter if provided
-            user_id = request.args.get('user_id')
-            if user_id:
-                query = query.where(Device.user_id == user_id)
-            
-            # Add platform filter if provided
-            platform = request.args.get('platform')
-            if platform:
-                query = query.where(Device.platform == platform)
-            
+        try:
+            after = int(request.args['after']) if request.args.get('after') else None
+            limit = min(max(int(request.args['limit']), 1), DEVICE_LIST_MAX_LIMIT) if request.args.get('limit') else None
+        except ValueError:
+            return jsonify({"error": "after and limit must be integers"}), 400
+
+        query = device_list_query(g.project_id, request.args, after, limit)
+
+        # Streaming mode: chunked NDJSON, constant memory per request
+        if request.args.get('format') == 'ndjson':
+            return Response(stream_with_context(stream_devices(query)), mimetype='application/x-ndjson')
+
+        with read_connection(g.project_id) as conn:
             # Execute query
             devices = conn.execute(query).fetchall()
             
             # Convert to dict and handle web push tokens
-            device_list = []
-            for device in devices:
-                device_dict = device._asdict()
-                if device_dict['platform'] == 'web':
-                    device_dict['token'] = json.loads(device_dict['token'])
-                device_list.append(device_dict)
-            
-            return jsonify(device_list), 200
+            device_list = [format_device(device) for device in devices]
+
+            response = jsonify(device_list)
+            if limit and len(devices) == limit:
+                response.headers['X-Next-After'] = str(devices[-1].id)
+            return response, 200
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -148,7 +236,7 @@ def delete_device(device_id):
             if not device:
                 return jsonify({"error": "Device not found"}), 404
             
-            # Delete device
+            # Delete device; messages sent to it keep their row with device_id set to null
             conn.execute(
                 Device.__table__.delete().where(
                     and_(
@@ -158,8 +246,48 @@ def delete_device(device_id):
                 )
             )
             conn.commit()
+
+            # Remove the device from its topics
+            unsubscribe(g.project_id, device.id, device.topics)
             
             return '', 204
             
     except Exception as e:
-        return jsonify({"error": str(e)}), 500 
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/<device_id>/topics', methods=['PUT'])
+def set_device_topics(device_id):
+    try:
+        data = request.get_json()
+        topics = data.get('topics') if isinstance(data, dict) else None
+        if topics is None or not valid_topics(topics):
+            return jsonify({"error": "topics must be a list of strings"}), 400
+        topics = list(dict.fromkeys(topics))
+
+        with engine.connect() as conn:
+            # Lock the device so concurrent topic changes apply in order
+            current = conn.execute(
+                select(Device.topics).where(
+                    Device.id == device_id,
+                    Device.project_id == g.project_id
+                ).with_for_update()
+            ).first()
+            if not current:
+                return jsonify({"error": "Device not found"}), 404
+
+            conn.execute(
+                Device.__table__.update()
+                .where(Device.id == device_id, Device.project_id == g.project_id)
+                .values(topics=topics)
+            )
+            conn.commit()
+
+        # Mirror the change in Redis
+        unsubscribe(g.project_id, device_id, set(current.topics or []) - set(topics))
+        subscribe(g.project_id, [(device_id, topics)])
+
+        return jsonify({'id': int(device_id), 'topics': topics}), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
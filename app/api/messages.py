@@ -1,15 +1,41 @@
 from flask import Blueprint, jsonify, request, g
-from sqlalchemy import delete, select, and_
-from app.database import engine
-from app.db.models import Message, Device, Project
-from app.redis import redis_client
-from datetime import datetime
+from sqlalchemy import delete, select, and_, or_, func, tuple_, any_, literal, String, BigInteger
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from app.database import engine, read_connection
+from app.db.models import Message, Device, Project, Delivery
+from app.queue import enqueue_tasks, store_message_payload, store_message_payloads, PRIORITIES, MESSAGE_PAYLOAD_TTL
+from app.deliveries import get_delivery_stats
+from app.utils.idempotency import idempotent
+from app.fanout import device_batches, device_tasks, queue_device_tasks, start_fan_out, get_fan_out_progress
+from datetime import datetime, timedelta, timezone
 import traceback
+import base64
+import re
 import json
+import os
+
+MESSAGE_BATCH_MAX_SIZE = int(os.environ.get('MESSAGE_BATCH_MAX_SIZE', 10000))
+MESSAGE_LIST_MAX_LIMIT = int(os.environ.get('MESSAGE_LIST_MAX_LIMIT', 100))
+DELIVERY_LIST_MAX_LIMIT = int(os.environ.get('DELIVERY_LIST_MAX_LIMIT', 1000))
+
+# Web Push topics allow at most 32 URL-safe base64 characters, the tightest provider limit
+COLLAPSE_KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,32}')
 
 bp = Blueprint('messages', __name__, url_prefix='/messages')
 
+def batch_devices_query(project_id, user_ids, device_ids):
+    """Live devices of every recipient of a batch, by user id or device id"""
+    return select(Device.id, Device.user_id, Device.platform, Device.token).where(
+        Device.project_id == project_id,
+        Device.invalidated_at.is_(None),
+        or_(
+            Device.user_id == any_(literal(user_ids, ARRAY(String))),
+            Device.id == any_(literal(device_ids, ARRAY(BigInteger)))
+        )
+    )
+
 @bp.route('', methods=['POST'])
+@idempotent
 def send_message():
     try:
         data = request.get_json()
@@ -19,6 +45,39 @@ def send_message():
         for field in required_fields:
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
+
+        if data.get('priority', 'normal') not in PRIORITIES:
+            return jsonify({"error": f"Invalid priority, expected one of: {', '.join(PRIORITIES)}"}), 400
+
+        # Validate targeting up front; async fan-outs only run it later in the worker
+        for field in ['userId', 'platform', 'topic']:
+            if field in data and not isinstance(data[field], str):
+                return jsonify({"error": f"{field} must be a string"}), 400
+        if 'device_id' in data:
+            if isinstance(data['device_id'], bool) or not str(data['device_id']).isdigit():
+                return jsonify({"error": "device_id must be an integer"}), 400
+            data['device_id'] = int(data['device_id'])
+
+        collapse_key = data.get('collapse_key')
+        if collapse_key is not None and not (isinstance(collapse_key, str) and COLLAPSE_KEY_PATTERN.fullmatch(collapse_key)):
+            return jsonify({"error": "collapse_key must be 1-32 characters of A-Z, a-z, 0-9, _ or -"}), 400
+
+        # Scheduled delivery: send_at, optionally at each device's local time,
+        # spread over a window of seconds
+        payload_ttl = MESSAGE_PAYLOAD_TTL
+        if data.get('send_at'):
+            try:
+                send_at = datetime.fromisoformat(data['send_at'])
+            except (TypeError, ValueError):
+                return jsonify({"error": "send_at must be an ISO 8601 timestamp"}), 400
+            spread = data.get('spread', 0)
+            if not isinstance(spread, (int, float)) or spread < 0:
+                return jsonify({"error": "spread must be a non-negative number of seconds"}), 400
+            last_due = send_at if send_at.tzinfo else send_at.replace(tzinfo=timezone.utc)
+            if data.get('local_time'):
+                # UTC-12 is the last timezone to reach a local send time
+                last_due = send_at.replace(tzinfo=timezone.utc) + timedelta(hours=12)
+            payload_ttl += max(0, int(last_due.timestamp() + spread - datetime.now(timezone.utc).timestamp()))
         
         # Create message record
         with engine.connect() as conn:
@@ -30,6 +89,7 @@ def send_message():
                 body=data['body'],
                 icon=data.get('icon'),
                 action_url=data.get('action_url'),
+                collapse_key=collapse_key,
                 project_id=g.project_id
             )
             result = conn.execute(Message.__table__.insert().returning(Message), message.__dict__)
@@ -39,26 +99,6 @@ def send_message():
             if not message:
                 return jsonify({"error": "Failed to create message"}), 500
             
-            # Get target devices
-            devices_query = select(Device).where(Device.project_id == g.project_id)
-            
-            # Add user_id filter if specified
-            if 'userId' in data:
-                devices_query = devices_query.where(Device.user_id == data['userId'])
-                
-            # Filter by platform if specified
-            if 'platform' in data:
-                devices_query = devices_query.where(Device.platform == data['platform'])
-                
-            # Filter by device identifier if specified
-            if 'device_id' in data:
-                devices_query = devices_query.where(Device.id == data['device_id'])
-                
-            devices = conn.execute(devices_query).fetchall()
-            
-            if not devices:
-                return jsonify({"error": "No matching devices found"}), 404
-            
             # Fetch project credentials
             project_query = conn.execute(
                 select(Project).where(Project.id == g.project_id)
@@ -66,40 +106,28 @@ def send_message():
             project = project_query._asdict() if project_query else {}
             # project = decrypt_project_credentials(project) #decrypt on th worker
 
-            # Queue tasks for each device
-            for device in devices:
-                task_data = {
-                    'project_id': str(g.project_id),
-                    'message_id': str(message.id),
-                    'device_id': str(device.id),
-                    'platform': device.platform,
-                    'token': device.token,
+            # Store message and credential snapshot once, tasks only reference it
+            store_message_payload(message._asdict(), project, payload_ttl)
+
+            # Async mode: stream devices and enqueue them in the background
+            if data.get('async'):
+                start_fan_out(message.id, data)
+                return jsonify({
+                    'id': str(message.id),
                     'title': message.title,
                     'body': message.body,
-                    'action_url': message.action_url,
-                    'icon': message.icon
-                }
+                    'createdAt': message.created_at,
+                    'fanout': get_fan_out_progress(message.id)
+                }), 202
+
+            # Get target devices
+            devices = [device for batch in device_batches(conn, g.project_id, data) for device in batch]
+            
+            if not devices:
+                return jsonify({"error": "No matching devices found"}), 404
 
-                # Add platform-specific credentials
-                if device.platform == 'ios':
-                    task_data.update({
-                        'apns_key_id': project.get('apns_key_id'),
-                        'apns_team_id': project.get('apns_team_id'),
-                        'apns_bundle_id': project.get('apns_bundle_id'),
-                        'apns_private_key': project.get('apns_private_key')
-                    })
-                elif device.platform == 'android':
-                    task_data.update({
-                        'fcm_credentials_json': project.get('fcm_credentials_json')
-                    })
-                elif device.platform == 'web':
-                    task_data.update({
-                        'vapid_private_key': project.get('vapid_private_key'),
-                        'vapid_subject': project.get('vapid_subject')
-                    })
-
-                # Queue the task in Redis
-                redis_client.lpush('push_tasks', json.dumps(task_data))
+            # Queue (or schedule) the tasks in Redis in pipelined chunks
+            enqueued, enqueue_ms = queue_device_tasks(message.id, devices, g.project_id, data)
             
             # Format response
             response_data = {
@@ -109,7 +137,9 @@ def send_message():
                 'icon': message.icon,
                 'action_url': message.action_url,
                 'createdAt': message.created_at,
-                'devices': [device._asdict() for device in devices]
+                'devices': [device._asdict() for device in devices],
+                'enqueued': enqueued,
+                'enqueueMs': enqueue_ms
             }
             
             # Only include optional fields if they were specified
@@ -119,6 +149,12 @@ def send_message():
                 response_data['platform'] = data['platform']
             if 'device_id' in data:
                 response_data['device_id'] = data['device_id']
+            if 'topic' in data:
+                response_data['topic'] = data['topic']
+            if data.get('send_at'):
+                response_data['sendAt'] = data['send_at']
+            if collapse_key:
+                response_data['collapse_key'] = collapse_key
             
             return jsonify(response_data), 200
             
@@ -126,34 +162,178 @@ def send_message():
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@bp.route('/batch', methods=['POST'])
+@idempotent
+def send_message_batch():
+    try:
+        data = request.get_json()
+        items = data.get('messages') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Missing required field: messages"}), 400
+        if len(items) > MESSAGE_BATCH_MAX_SIZE:
+            return jsonify({"error": f"At most {MESSAGE_BATCH_MAX_SIZE} messages per batch"}), 400
+        if data.get('priority', 'normal') not in PRIORITIES:
+            return jsonify({"error": f"Invalid priority, expected one of: {', '.join(PRIORITIES)}"}), 400
+
+        # Validate items: content plus a userId or device_id recipient
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                return jsonify({"error": f"Message {index} must be an object"}), 400
+            for field in ['title', 'body']:
+                if field not in item:
+                    return jsonify({"error": f"Missing required field: {field} (message {index})"}), 400
+            if 'userId' not in item and 'device_id' not in item:
+                return jsonify({"error": f"Missing recipient: userId or device_id (message {index})"}), 400
+            if 'userId' in item and not isinstance(item['userId'], str):
+                return jsonify({"error": f"userId must be a string (message {index})"}), 400
+            if 'device_id' in item:
+                if isinstance(item['device_id'], bool) or not str(item['device_id']).isdigit():
+                    return jsonify({"error": f"device_id must be an integer (message {index})"}), 400
+                item['device_id'] = int(item['device_id'])
+
+        with engine.connect() as conn:
+            # Resolve every recipient's devices in one query
+            user_ids = list({item['userId'] for item in items if 'userId' in item})
+            device_ids = list({item['device_id'] for item in items if 'device_id' in item})
+            devices = conn.execute(batch_devices_query(g.project_id, user_ids, device_ids)).fetchall()
+            by_user = {}
+            by_id = {}
+            for device in devices:
+                by_user.setdefault(device.user_id, []).append(device)
+                by_id[device.id] = device
+
+            # Insert all messages in one multi-row statement. Only devices found
+            # above are referenced, so an unknown device_id cannot fail the batch.
+            messages = conn.execute(
+                insert(Message).returning(Message, sort_by_parameter_order=True),
+                [
+                    {
+                        'project_id': g.project_id,
+                        'user_id': item.get('userId'),
+                        'device_id': item['device_id'] if item.get('device_id') in by_id else None,
+                        'platform': item.get('platform'),
+                        'title': item['title'],
+                        'body': item['body'],
+                        'icon': item.get('icon'),
+                        'action_url': item.get('action_url')
+                    }
+                    for item in items
+                ]
+            ).fetchall()
+            conn.commit()
+
+            # Fetch project credentials once
+            project_query = conn.execute(
+                select(Project).where(Project.id == g.project_id)
+            ).first()
+            project = project_query._asdict() if project_query else {}
+
+        store_message_payloads([message._asdict() for message in messages], project)
+
+        # Build every task and enqueue them in one pipeline
+        tasks = []
+        results = []
+        for item, message in zip(items, messages):
+            if 'device_id' in item:
+                targets = [by_id[item['device_id']]] if item['device_id'] in by_id else []
+            else:
+                targets = by_user.get(item['userId'], [])
+            if 'platform' in item:
+                targets = [device for device in targets if device.platform == item['platform']]
+            tasks.extend(device_tasks(message.id, targets))
+            results.append({'id': str(message.id), 'devices': len(targets)})
+        enqueued, enqueue_ms = enqueue_tasks(tasks, g.project_id, data.get('priority', 'normal'))
+
+        return jsonify({
+            'messages': results,
+            'enqueued': enqueued,
+            'enqueueMs': enqueue_ms
+        }), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+def message_filters(project_id, args):
+    """Build the list filters for GET /messages from query parameters"""
+    filters = [Message.project_id == project_id]
+
+    if args.get('userId'):
+        filters.append(Message.user_id == args.get('userId'))
+
+    if args.get('platform'):
+        filters.append(Message.platform == args.get('platform'))
+
+    if args.get('deviceId'):
+        filters.append(Message.device_id == args.get('deviceId'))
+
+    if args.get('category'):
+        filters.append(Message.category == args.get('category'))
+
+    return filters
+
+def message_query(project_id, id):
+    return select(Message).where(and_(Message.id == id, Message.project_id == project_id))
+
+def deliveries_page_query(project_id, message_id, after, limit):
+    """A message's deliveries, keyset paged on delivery id"""
+    return select(Delivery).where(
+        Delivery.message_id == message_id,
+        Delivery.project_id == project_id,
+        Delivery.id > after
+    ).order_by(Delivery.id).limit(limit)
+
+def message_list_query(filters):
+    """Messages matching the list filters, newest first"""
+    return select(Message).where(*filters).order_by(Message.created_at.desc(), Message.id.desc())
+
+def encode_cursor(message):
+    """Opaque keyset cursor for the (created_at, id) of the last message on a page"""
+    return base64.urlsafe_b64encode(
+        json.dumps([message.created_at.isoformat(), message.id]).encode()
+    ).decode()
+
+def decode_cursor(cursor):
+    created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(created_at), int(id)
+
+def estimate_count(conn, query):
+    """Planner row estimate for a query, avoiding a full count on very large projects"""
+    # Filter values stay bound parameters, never rendered into the SQL
+    compiled = query.compile(dialect=conn.dialect)
+    plan = conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
 @bp.route('', methods=['GET'])
 def list_messages():
     try:
-        with engine.connect() as conn:
-            # Start with base query
-            query = select(Message).where(Message.project_id == g.project_id)
-            
+        try:
+            limit = min(max(int(request.args.get('limit', 10)), 1), MESSAGE_LIST_MAX_LIMIT)
+            offset = max(int(request.args.get('offset') or 0), 0)
+        except ValueError:
+            return jsonify({"error": "limit and offset must be integers"}), 400
+
+        with read_connection(g.project_id) as conn:
             # Apply filters from query parameters
-            if request.args.get('userId'):
-                query = query.where(Message.user_id == request.args.get('userId'))
-                
-            if request.args.get('platform'):
-                query = query.where(Message.platform == request.args.get('platform'))
-                
-            if request.args.get('deviceId'):
-                # Join with devices table to filter by device ID
-                query = query.where(Message.device_id == request.args.get('deviceId'))
-                
-            if request.args.get('category'):
-                query = query.where(Message.category == request.args.get('category'))
-            
-            # Apply pagination
-            limit = int(request.args.get('limit', 10))
-            offset = int(request.args.get('offset', 0))
-            query = query.limit(limit).offset(offset)
-            
-            # Execute query
-            messages = conn.execute(query).fetchall()
+            filters = message_filters(g.project_id, request.args)
+            query = message_list_query(filters)
+
+            # Apply keyset pagination on (created_at, id), newest first
+            cursor = request.args.get('cursor')
+            if cursor:
+                try:
+                    created_at, id = decode_cursor(cursor)
+                except (ValueError, TypeError):
+                    return jsonify({"error": "Invalid cursor"}), 400
+                query = query.where(tuple_(Message.created_at, Message.id) < tuple_(created_at, id))
+            elif offset:
+                # Legacy offset pagination
+                query = query.offset(offset)
+
+            # Fetch one extra row to know whether there is a next page
+            messages = conn.execute(query.limit(limit + 1)).fetchall()
+            next_cursor = encode_cursor(messages[limit - 1]) if len(messages) > limit else None
+            messages = messages[:limit]
             
             # Format response
             formatted_messages = []
@@ -170,22 +350,19 @@ def list_messages():
                     'createdAt': message_dict['created_at']
                 })
             
-            # Get total count with same filters
-            count_query = select(Message).where(Message.project_id == g.project_id)
-            if request.args.get('userId'):
-                count_query = count_query.where(Message.user_id == request.args.get('userId'))
-            if request.args.get('platform'):
-                count_query = count_query.where(Message.platform == request.args.get('platform'))
-            if request.args.get('deviceId'):
-                count_query = count_query.where(Message.device_id == request.args.get('deviceId'))
-            if request.args.get('category'):
-                count_query = count_query.where(Message.category == request.args.get('category'))
-            
-            total = len(conn.execute(count_query).fetchall())
+            # Get total count with same filters: exact, estimated or skipped
+            count_mode = request.args.get('count', 'exact')
+            if count_mode == 'estimate':
+                total = estimate_count(conn, select(Message.id).where(*filters))
+            elif count_mode == 'none':
+                total = None
+            else:
+                total = conn.execute(select(func.count()).select_from(Message).where(*filters)).scalar()
             
             return jsonify({
                 'messages': formatted_messages,
-                'total': total
+                'total': total,
+                'next_cursor': next_cursor
             }), 200
             
     except Exception as e:
@@ -194,16 +371,9 @@ def list_messages():
 @bp.route('/<id>', methods=['GET'])
 def get_message(id):
     try:
-        with engine.connect() as conn:
+        with read_connection(g.project_id) as conn:
             # Get message
-            message = conn.execute(
-                select(Message).where(
-                    and_(
-                        Message.id == id,
-                        Message.project_id == g.project_id
-                    )
-                )
-            ).first()
+            message = conn.execute(message_query(g.project_id, id)).first()
             
             if not message:
                 return jsonify({"error": "Message not found"}), 404
@@ -216,11 +386,50 @@ def get_message(id):
                 'userId': message_dict.get('user_id'),
                 'title': message_dict['title'],
                 'body': message_dict['body'],
-                'createdAt': message_dict['created_at'],
-                'devices': []  # Devices will be handled by Redis/worker
+                'createdAt': message_dict['created_at']
             }
+
+            # Live delivery counters; per-device outcomes are paged from /deliveries
+            response_data['stats'] = get_delivery_stats(message_dict['id'])
+
+            # Include background fan-out progress for async sends
+            fanout = get_fan_out_progress(message_dict['id'])
+            if fanout:
+                response_data['fanout'] = fanout
             
             return jsonify(response_data), 200
             
     except Exception as e:
-        return jsonify({"error": str(e)}), 500 
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500 
+
+@bp.route('/<id>/deliveries', methods=['GET'])
+def get_message_deliveries(id):
+    try:
+        try:
+            message_id = int(id)
+            after = int(request.args.get('after') or 0)
+            limit = min(max(int(request.args.get('limit', 100)), 1), DELIVERY_LIST_MAX_LIMIT)
+        except ValueError:
+            return jsonify({"error": "id, after and limit must be integers"}), 400
+
+        # Per-device outcomes, keyset paged on delivery id
+        with read_connection(g.project_id) as conn:
+            deliveries = conn.execute(deliveries_page_query(g.project_id, message_id, after, limit)).fetchall()
+
+        return jsonify({
+            'deliveries': [
+                {
+                    'id': str(delivery.id),
+                    'deviceId': str(delivery.device_id),
+                    'status': delivery.status,
+                    'statusCode': delivery.status_code,
+                    'error': delivery.error,
+                    'createdAt': delivery.created_at
+                }
+                for delivery in deliveries
+            ],
+            'next_after': str(deliveries[-1].id) if len(deliveries) == limit else None
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
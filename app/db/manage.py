@@ -1,5 +1,6 @@
 import click
-from app.db.migrations import run_migrations, seed_database, reset_database
+import os
+from app.db.migrations import run_migrations, seed_database, reset_database, maintain_message_partitions
 
 @click.group()
 def cli():
@@ -21,5 +22,24 @@ def reset():
     """Reset the database and run migrations and seeds"""
     reset_database()
 
+@cli.command()
+@click.option('--months-ahead', default=3, help='Monthly partitions to create ahead of now')
+@click.option('--retention-days', default=int(os.environ.get('MESSAGE_RETENTION_DAYS', 90)),
+              help='Retention for projects without message_retention_days')
+@click.option('--detach', is_flag=True, help='Detach expired partitions instead of dropping them')
+def partitions(months_ahead, retention_days, detach):
+    """Create upcoming messages partitions and prune expired ones"""
+    maintain_message_partitions(months_ahead, retention_days, detach)
+
+@cli.command()
+def explain():
+    """Fail if any blueprint query plans a sequential scan"""
+    from app.db.query_plans import check_query_plans
+    failures = check_query_plans()
+    if failures:
+        raise click.ClickException(
+            'Sequential scans: ' + ', '.join(f'{name} ({relation})' for name, relation in failures)
+        )
+
 if __name__ == '__main__':
     cli() 
\ No newline at end of file
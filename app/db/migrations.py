@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
 from app.database import engine
 from dotenv import load_dotenv
@@ -67,4 +68,54 @@ def reset_database():
     # Run migrations and seed
     run_migrations()
     seed_database()
-    print("Database reset complete") 
\ No newline at end of file
+    print("Database reset complete")
+
+def add_months(month, count):
+    year, index = divmod(month.month - 1 + count, 12)
+    return month.replace(year=month.year + year, month=index + 1, day=1)
+
+def maintain_message_partitions(months_ahead=3, default_retention_days=90, detach_only=False):
+    """
+    Create upcoming monthly messages partitions, delete messages past each
+    project's retention window and drop (or detach) partitions that are past
+    every project's window.
+    """
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+
+    with engine.connect() as conn:
+        # Create partitions ahead of time
+        for i in range(months_ahead + 1):
+            conn.execute(text("SELECT create_messages_partition(:month)"), {"month": add_months(this_month, i)})
+        conn.commit()
+
+        # Per-project retention, only touches partitions older than the cutoff
+        projects = conn.execute(text("SELECT id, message_retention_days FROM projects")).fetchall()
+        longest_retention = default_retention_days
+        for project_id, retention_days in projects:
+            retention_days = retention_days or default_retention_days
+            longest_retention = max(longest_retention, retention_days)
+            result = conn.execute(
+                text("DELETE FROM messages WHERE project_id = :project_id AND created_at < :cutoff"),
+                {"project_id": project_id, "cutoff": datetime.now(timezone.utc) - timedelta(days=retention_days)}
+            )
+            conn.commit()
+            if result.rowcount:
+                print(f"Deleted {result.rowcount} expired messages for project {project_id}")
+
+        # Drop or detach whole partitions past every project's retention
+        cutoff = datetime.now(timezone.utc).date() - timedelta(days=longest_retention)
+        conn.execute(text("DELETE FROM deliveries WHERE created_at < :cutoff"), {"cutoff": cutoff})
+        conn.commit()
+        partitions = conn.execute(text("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'messages'::regclass AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$'
+        """)).scalars().all()
+        for partition in sorted(partitions):
+            month = datetime.strptime(partition, 'messages_%Y_%m').date()
+            if add_months(month, 1) <= cutoff:
+                conn.execute(text(f'ALTER TABLE messages DETACH PARTITION "{partition}"'))
+                if not detach_only:
+                    conn.execute(text(f'DROP TABLE "{partition}"'))
+                conn.commit()
+                print(f"{'Detached' if detach_only else 'Dropped'} partition {partition}")
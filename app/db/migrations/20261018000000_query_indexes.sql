@@ -0,0 +1,11 @@
+-- Device targeting: project + user (send_message, get_devices).
+-- project + platform is served by the (project_id, platform, token) unique index.
+create index if not exists devices_project_id_user_id_idx
+  on devices (project_id, user_id);
+
+-- Message listing: newest first per project, optionally per user
+create index if not exists messages_project_id_created_at_id_idx
+  on messages (project_id, created_at desc, id desc);
+
+create index if not exists messages_project_id_user_id_created_at_id_idx
+  on messages (project_id, user_id, created_at desc, id desc);
@@ -0,0 +1,75 @@
+-- Per-project message retention in days (null = the retention job's default)
+alter table projects add column message_retention_days integer;
+
+-- Creates the monthly messages partition containing the given date
+create or replace function create_messages_partition(month date) returns void as $$
+declare
+  start_date date := date_trunc('month', month);
+begin
+  execute format(
+    'create table if not exists %I partition of messages for values from (%L) to (%L)',
+    'messages_' || to_char(start_date, 'YYYY_MM'), start_date, start_date + interval '1 month'
+  );
+end;
+$$ language plpgsql;
+
+-- Replace messages with a table partitioned by created_at month
+alter table messages rename to messages_unpartitioned;
+drop index if exists messages_project_id_created_at_id_idx;
+drop index if exists messages_project_id_user_id_created_at_id_idx;
+
+create table messages (
+  id bigint generated always as identity,
+  project_id text not null references projects(id),
+  user_id text,
+  platform text,
+  device_id bigint references devices(id),
+  title text not null,
+  body text not null,
+  icon text,
+  action_url text,
+  created_at timestamp with time zone not null default timezone('utc'::text, now()),
+  updated_at timestamp with time zone default timezone('utc'::text, now()),
+  primary key (id, created_at)
+) partition by range (created_at);
+
+-- Catches rows outside the created partitions
+create table messages_default partition of messages default;
+
+-- Partitions for existing rows, this month and the next two
+do $$
+declare
+  month date;
+begin
+  for month in
+    select generate_series(
+      date_trunc('month', coalesce((select min(created_at) from messages_unpartitioned), now())),
+      date_trunc('month', now()) + interval '2 months',
+      interval '1 month'
+    )::date
+  loop
+    perform create_messages_partition(month);
+  end loop;
+end;
+$$;
+
+insert into messages (id, project_id, user_id, platform, device_id, title, body, icon, action_url, created_at, updated_at)
+overriding system value
+select id, project_id, user_id, platform, device_id, title, body, icon, action_url,
+       coalesce(created_at, timezone('utc'::text, now())), updated_at
+from messages_unpartitioned;
+
+select setval(pg_get_serial_sequence('messages', 'id'), coalesce((select max(id) from messages), 0) + 1, false);
+
+drop table messages_unpartitioned;
+
+create index messages_project_id_created_at_id_idx
+  on messages (project_id, created_at desc, id desc);
+
+create index messages_project_id_user_id_created_at_id_idx
+  on messages (project_id, user_id, created_at desc, id desc);
+
+CREATE TRIGGER update_messages_updated_at
+    BEFORE UPDATE ON messages
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
@@ -0,0 +1,14 @@
+-- Per-device delivery outcomes, written in batches by the worker
+create table deliveries (
+  id bigint primary key generated always as identity,
+  project_id text not null references projects(id),
+  message_id bigint not null,
+  device_id bigint not null,
+  status text not null,
+  status_code integer,
+  error text,
+  created_at timestamp with time zone not null default timezone('utc'::text, now())
+);
+
+create index deliveries_message_id_status_idx on deliveries (message_id, status);
+create index deliveries_created_at_idx on deliveries (created_at);
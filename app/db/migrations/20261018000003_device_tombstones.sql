@@ -0,0 +1,2 @@
+-- Set when a provider reports the token as dead; tombstoned devices are not targeted
+alter table devices add column invalidated_at timestamp with time zone;
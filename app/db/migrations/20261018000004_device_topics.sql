@@ -0,0 +1,3 @@
+-- Topics a device is subscribed to. Membership is mirrored in Redis sorted
+-- sets (topic:<project_id>:<topic>) for fan-out.
+alter table devices add column topics text[];
@@ -0,0 +1,3 @@
+-- Per-endpoint ingress limits: {"<endpoint>": {"rate": <per second>, "burst": <n>}}.
+-- Mirrored in Redis (rate_limits:<project_id>) where the token bucket reads them.
+alter table projects add column rate_limits jsonb;
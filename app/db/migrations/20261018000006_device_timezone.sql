@@ -0,0 +1,2 @@
+-- IANA timezone (e.g. Europe/Paris) for messages delivered at the device's local time
+alter table devices add column timezone text;
@@ -0,0 +1,2 @@
+-- Queued tasks for a device are superseded by newer messages with the same key
+alter table messages add column collapse_key text;
@@ -0,0 +1,2 @@
+-- Keyset pages of a message's deliveries (GET /messages/<id>/deliveries)
+create index deliveries_message_id_id_idx on deliveries (message_id, id);
@@ -0,0 +1,20 @@
+-- Batch sends store the target device on the message; deleting the device
+-- clears that reference instead of failing on the foreign key
+do $$
+declare
+  constraint_name text;
+begin
+  for constraint_name in
+    select conname from pg_constraint
+    where conrelid = 'messages'::regclass and confrelid = 'devices'::regclass and contype = 'f'
+  loop
+    execute format('alter table messages drop constraint %I', constraint_name);
+  end loop;
+end;
+$$;
+
+alter table messages
+  add constraint messages_device_id_fkey foreign key (device_id) references devices(id) on delete set null;
+
+-- Lets the set null find a deleted device's messages without scanning every partition
+create index messages_device_id_idx on messages (device_id) where device_id is not null;
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Boolean, ARRAY, DateTime, BigInteger, ForeignKey, UniqueConstraint, PrimaryKeyConstraint, ForeignKeyConstraint
+from sqlalchemy import Column, String, Boolean, Integer, ARRAY, DateTime, BigInteger, ForeignKey, UniqueConstraint, PrimaryKeyConstraint, ForeignKeyConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -20,6 +21,8 @@ class Project(Base):
     apns_team_id = Column(String, nullable=True)
     apns_bundle_id = Column(String, nullable=True)
     apns_private_key = Column(String, nullable=True)
+    message_retention_days = Column(Integer, nullable=True)
+    rate_limits = Column(JSONB, nullable=True)
 
 class Device(Base):
     __tablename__ = 'devices'
@@ -29,6 +32,9 @@ class Device(Base):
     user_id = Column(String, nullable=True)
     platform = Column(String, nullable=False)
     token = Column(String, nullable=False)
+    invalidated_at = Column(DateTime(timezone=True), nullable=True)
+    topics = Column(ARRAY(String), nullable=True)
+    timezone = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -37,16 +43,29 @@ class Device(Base):
     )
 
 class Message(Base):
-    __tablename__ = 'messages'
+    __tablename__ = 'messages'  # partitioned by created_at month
     
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     project_id = Column(String, ForeignKey('projects.id'), nullable=False)
     user_id = Column(String, nullable=True)
     platform = Column(String, nullable=True)
-    device_id = Column(BigInteger, ForeignKey('devices.id'), nullable=True)
+    device_id = Column(BigInteger, ForeignKey('devices.id', ondelete='SET NULL'), nullable=True)
     title = Column(String, nullable=False)
     body = Column(String, nullable=False)
     icon = Column(String, nullable=True)
     action_url = Column(String, nullable=True)
+    collapse_key = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Delivery(Base):
+    __tablename__ = 'deliveries'
+    
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    project_id = Column(String, ForeignKey('projects.id'), nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    device_id = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
-    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow) 
\ No newline at end of file
@@ -0,0 +1,58 @@
+from sqlalchemy import text, select, func
+from app.database import engine
+from app.db.models import Project, Message
+from app.fanout import devices_query
+from app.topics import topic_page_query
+from app.deliveries import delivery_stats_query
+from app.api.devices import upsert_devices, device_list_query
+from app.api.messages import (
+    batch_devices_query, message_filters, message_list_query, message_query, deliveries_page_query
+)
+
+def blueprint_queries(project_id='query-plan-check'):
+    """The query shapes issued by the blueprints, keyed by a readable name"""
+    return {
+        'authenticate': select(Project.id).where(Project.api_key == 'query-plan-check'),
+        'send_message devices': devices_query(project_id, {}),
+        'send_message devices by user': devices_query(project_id, {'userId': 'user'}),
+        'send_message devices by platform': devices_query(project_id, {'platform': 'ios'}),
+        'send_message devices by id': devices_query(project_id, {'device_id': 1}),
+        'send_message devices by topic page': topic_page_query(devices_query(project_id, {}), 'topic', [1, 2]),
+        'register_device upsert': upsert_devices([{
+            'project_id': project_id, 'user_id': None, 'platform': 'ios', 'token': 'token',
+            'topics': None, 'timezone': None
+        }]),
+        'send_message_batch devices': batch_devices_query(project_id, ['user'], [1]),
+        'get_devices by user and platform': device_list_query(project_id, {'user_id': 'user', 'platform': 'ios'}),
+        'get_devices page': device_list_query(project_id, {}, after=1, limit=1000),
+        'list_messages': message_list_query(message_filters(project_id, {})).limit(11),
+        'list_messages by user': message_list_query(message_filters(project_id, {'userId': 'user'})).limit(11),
+        'list_messages count': select(func.count()).select_from(Message).where(*message_filters(project_id, {})),
+        'get_message': message_query(project_id, 1),
+        'get_message delivery stats': delivery_stats_query(1),
+        'get_message_deliveries': deliveries_page_query(project_id, 1, after=1, limit=100),
+    }
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def check_query_plans():
+    """
+    EXPLAIN every blueprint query with sequential scans disabled, so any query
+    without a usable index still shows up as a Seq Scan.
+
+    Returns:
+        List of (query name, relation) pairs that regressed to a sequential scan
+    """
+    failures = []
+    with engine.connect() as conn:
+        conn.execute(text('SET enable_seqscan = off'))
+        for name, query in blueprint_queries().items():
+            sql = query.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+            plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()[0]['Plan']
+            seq_scans = [node['Relation Name'] for node in plan_nodes(plan) if node['Node Type'] == 'Seq Scan']
+            print(f"{'FAIL' if seq_scans else 'ok'}: {name}")
+            failures.extend((name, relation) for relation in seq_scans)
+    return failures
@@ -0,0 +1,108 @@
+import os
+import time
+from datetime import datetime, timezone
+from sqlalchemy import select, func, insert, update, values, column, BigInteger, DateTime
+from app.database import engine
+from app.db.models import Delivery, Device
+from app.redis import redis_client
+from app.topics import unsubscribe
+
+INVALID_DEVICE_BATCH_SIZE = int(os.environ.get('INVALID_DEVICE_BATCH_SIZE', 1000))
+
+STATUSES = ['queued', 'sent', 'failed', 'collapsed']
+
+# Bump a live counter only while its message hash exists, so counters for an
+# expired message don't re-create the hash without a TTL
+_incr_if_exists = redis_client.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+""")
+
+def record_deliveries(results):
+    """
+    Write final delivery outcomes in one multi-row insert and bump the live
+    per-message counters in one pipeline.
+
+    Args:
+        results: Dicts with project_id, message_id, device_id, status,
+            status_code and error
+    """
+    if not results:
+        return
+    with engine.begin() as conn:
+        conn.execute(insert(Delivery), results)
+
+    counts = {}
+    for result in results:
+        key = (result['message_id'], result['status'])
+        counts[key] = counts.get(key, 0) + 1
+    pipe = redis_client.pipeline(transaction=False)
+    for (message_id, status), count in counts.items():
+        _incr_if_exists(keys=[f'message:{message_id}'], args=[status, count], client=pipe)
+    pipe.execute()
+
+def delivery_stats_query(message_id):
+    return select(Delivery.status, func.count()).where(Delivery.message_id == message_id).group_by(Delivery.status)
+
+def get_delivery_stats(message_id):
+    """
+    Queued/sent/failed/collapsed counts for a message from its Redis counters, falling
+    back to counting deliveries once the counters have expired
+    """
+    counts = redis_client.hmget(f'message:{message_id}', STATUSES)
+    if counts[0] is not None:
+        return {status: int(count or 0) for status, count in zip(STATUSES, counts)}
+
+    with engine.connect() as conn:
+        rows = conn.execute(delivery_stats_query(message_id)).fetchall()
+    stats = {status: 0 for status in STATUSES}
+    stats.update({status: count for status, count in rows})
+    stats['queued'] = stats['sent'] + stats['failed'] + stats['collapsed']
+    return stats
+
+def report_invalid_devices(device_ids):
+    """Collect devices whose tokens providers reported dead, deduped in a sorted set"""
+    if device_ids:
+        now = time.time()
+        redis_client.zadd('invalid_devices', {str(device_id): now for device_id in device_ids})
+
+def prune_invalid_devices(limit=INVALID_DEVICE_BATCH_SIZE):
+    """
+    Tombstone reported devices in batches until the reports are drained.
+    Each device is compared with its own report time, so one re-registered
+    after it was reported is left alone.
+
+    Returns:
+        Number of devices tombstoned
+    """
+    total = 0
+    while True:
+        reported = redis_client.zpopmin('invalid_devices', limit)
+        if not reported:
+            return total
+        reports = values(
+            column('id', BigInteger), column('reported_at', DateTime(timezone=True)), name='reports'
+        ).data([
+            (int(device_id), datetime.fromtimestamp(score, timezone.utc)) for device_id, score in reported
+        ])
+        with engine.begin() as conn:
+            result = conn.execute(
+                update(Device)
+                .where(
+                    Device.id == reports.c.id,
+                    Device.invalidated_at.is_(None),
+                    Device.updated_at < reports.c.reported_at
+                )
+                .values(invalidated_at=func.now())
+                .returning(Device.id, Device.project_id, Device.topics)
+            )
+            tombstoned = result.fetchall()
+
+        # Tombstoned devices leave their topics
+        for device in tombstoned:
+            unsubscribe(device.project_id, device.id, device.topics)
+        total += len(tombstoned)
+        if len(reported) < limit:
+            return total
@@ -0,0 +1,123 @@
+import os
+import time
+from email.utils import parsedate_to_datetime
+from prometheus_client import Gauge
+
+EGRESS_INITIAL_LIMIT = float(os.environ.get('EGRESS_INITIAL_LIMIT', 50))
+EGRESS_MIN_LIMIT = float(os.environ.get('EGRESS_MIN_LIMIT', 1))
+EGRESS_MAX_LIMIT = float(os.environ.get('EGRESS_MAX_LIMIT', 1000))
+EGRESS_DECREASE_FACTOR = float(os.environ.get('EGRESS_DECREASE_FACTOR', 0.5))
+# Throttles within this window of the last decrease are one congestion event
+EGRESS_DECREASE_COOLDOWN = float(os.environ.get('EGRESS_DECREASE_COOLDOWN', 1))
+# How long a task is handed back for when its credential is at its limit or
+# throttled without a Retry-After
+EGRESS_DEFER_DELAY = float(os.environ.get('EGRESS_DEFER_DELAY', 1))
+
+EGRESS_LIMIT = Gauge('push_worker_egress_limit', 'Adaptive in-flight limit', ['platform', 'project'])
+EGRESS_IN_FLIGHT = Gauge('push_worker_egress_in_flight', 'Pushes in flight', ['platform', 'project'])
+
+def retry_after_seconds(response):
+    """Parse a Retry-After header (delay in seconds or HTTP date), or None"""
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def is_throttled(platform, response):
+    """Whether a provider response says we are sending too fast"""
+    if response.status_code in (429, 503):
+        return True
+    return platform == 'android' and 'QUOTA_EXCEEDED' in response.text
+
+class EgressLimit:
+    """
+    AIMD in-flight limit for one provider credential. Slots are taken without
+    waiting, so the worker never parks a task on a throttled credential.
+    """
+
+    def __init__(self, labels):
+        self.limit = EGRESS_INITIAL_LIMIT
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.limit_gauge = EGRESS_LIMIT.labels(*labels)
+        self.in_flight_gauge = EGRESS_IN_FLIGHT.labels(*labels)
+        self.limit_gauge.set(self.limit)
+
+    def pause_remaining(self):
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def available(self):
+        return not self.pause_remaining() and self.in_flight < int(self.limit)
+
+    def try_acquire(self):
+        """Take a slot if the credential is not paused or at its limit"""
+        if not self.available():
+            return False
+        self.in_flight += 1
+        self.in_flight_gauge.set(self.in_flight)
+        return True
+
+    def release(self, throttled=None, retry_after=None):
+        """Free a slot; throttled=None (the send errored) leaves the limit as is"""
+        self.in_flight -= 1
+        now = time.monotonic()
+        if throttled:
+            if now - self.last_decrease > EGRESS_DECREASE_COOLDOWN:
+                self.limit = max(EGRESS_MIN_LIMIT, self.limit * EGRESS_DECREASE_FACTOR)
+                self.last_decrease = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+        elif throttled is not None:
+            # Roughly +1 per limit's worth of successes
+            self.limit = min(EGRESS_MAX_LIMIT, self.limit + 1 / self.limit)
+        self.limit_gauge.set(self.limit)
+        self.in_flight_gauge.set(self.in_flight)
+
+class EgressController:
+    """
+    Adaptive concurrency per (project, platform): the limit grows additively
+    while the provider accepts pushes and halves when it throttles. A
+    Retry-After pauses that credential for the given time.
+    """
+
+    def __init__(self):
+        self.limits = {}
+
+    def limit(self, project_id, platform):
+        key = (project_id, platform)
+        if key not in self.limits:
+            self.limits[key] = EgressLimit((platform, project_id))
+        return self.limits[key]
+
+    def blocked_projects(self):
+        """Projects whose every known credential is paused or at its limit"""
+        open_projects = {}
+        for (project_id, _), limit in self.limits.items():
+            open_projects[project_id] = open_projects.get(project_id, False) or limit.available()
+        return {project_id for project_id, is_open in open_projects.items() if not is_open}
+
+    async def send(self, send, task, payload):
+        """
+        Run send(task, payload) on a slot already taken with try_acquire,
+        then release it and adapt the limit.
+
+        Returns:
+            Tuple of (response, retry_after seconds or None)
+        """
+        limit = self.limit(payload['project_id'], task['platform'])
+        try:
+            response = await send(task, payload)
+        except BaseException:
+            limit.release()
+            raise
+        retry_after = retry_after_seconds(response)
+        limit.release(is_throttled(task['platform'], response), retry_after)
+        return response, retry_after
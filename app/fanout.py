@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import random
+import traceback
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy import select
+from sqlalchemy.exc import DataError
+from app.database import engine
+from app.db.models import Device
+from app.queue import enqueue_tasks, schedule_tasks
+from app.topics import topic_device_batches
+from app.redis import redis_client
+
+FANOUT_BATCH_SIZE = int(os.environ.get('FANOUT_BATCH_SIZE', 1000))
+# A fan-out job whose worker stops renewing its lease is resumed by another
+FANOUT_LEASE_TTL = int(os.environ.get('FANOUT_LEASE_TTL', 60))
+FANOUT_RETRY_DELAY = float(os.environ.get('FANOUT_RETRY_DELAY', 10))
+FANOUT_MAX_ATTEMPTS = int(os.environ.get('FANOUT_MAX_ATTEMPTS', 5))
+
+def devices_query(project_id, filters, columns=(Device,)):
+    """Build the device targeting query for a message's filters"""
+    query = select(*columns).where(Device.project_id == project_id, Device.invalidated_at.is_(None))
+
+    # Add user_id filter if specified
+    if 'userId' in filters:
+        query = query.where(Device.user_id == filters['userId'])
+
+    # Filter by platform if specified
+    if 'platform' in filters:
+        query = query.where(Device.platform == filters['platform'])
+
+    # Filter by device identifier if specified
+    if 'device_id' in filters:
+        query = query.where(Device.id == filters['device_id'])
+
+    return query
+
+def device_batches(conn, project_id, filters, columns=(Device,), batch_size=FANOUT_BATCH_SIZE, after=0):
+    """
+    Yield batches of target devices with ids above after, in id order: topic
+    sends enumerate the topic's Redis members, everything else streams from a
+    server-side cursor.
+    """
+    query = devices_query(project_id, filters, columns)
+    if 'topic' in filters:
+        yield from topic_device_batches(conn, query, project_id, filters['topic'], batch_size, after)
+        return
+    query = query.where(Device.id > after).order_by(Device.id)
+    yield from conn.execution_options(yield_per=batch_size).execute(query).partitions()
+
+def device_tasks(message_id, devices, collapse_key=None):
+    """Build the per-device push tasks for a message, with web push subscriptions as objects"""
+    tasks = [
+        {
+            'message_id': str(message_id),
+            'device_id': str(device.id),
+            'platform': device.platform,
+            'token': json.loads(device.token) if device.platform == 'web' else device.token
+        }
+        for device in devices
+    ]
+    if collapse_key:
+        for task in tasks:
+            task['collapse_key'] = collapse_key
+    return tasks
+
+def device_zone(name):
+    """A device's timezone, UTC when unset or unknown"""
+    try:
+        return ZoneInfo(name) if name else timezone.utc
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone.utc
+
+def due_times(devices, filters):
+    """
+    When each device's task is due: send_at, read as wall-clock time in the
+    device's timezone with local_time, plus a random offset within the
+    spread window (seconds) to smooth large campaigns.
+    """
+    send_at = datetime.fromisoformat(filters['send_at'])
+    spread = float(filters.get('spread', 0))
+    for device in devices:
+        if filters.get('local_time'):
+            due = send_at.replace(tzinfo=device_zone(device.timezone))
+        else:
+            due = send_at if send_at.tzinfo else send_at.replace(tzinfo=timezone.utc)
+        yield due.timestamp() + random.uniform(0, spread)
+
+def queue_device_tasks(message_id, devices, project_id, filters):
+    """
+    Enqueue a message's tasks for a batch of devices, or schedule them when
+    the message has a send_at.
+
+    Returns:
+        Tuple of (number of tasks queued, elapsed milliseconds)
+    """
+    tasks = device_tasks(message_id, devices, filters.get('collapse_key'))
+    priority = filters.get('priority', 'normal')
+    if filters.get('send_at'):
+        return schedule_tasks(zip(tasks, due_times(devices, filters)), project_id, priority)
+    return enqueue_tasks(tasks, project_id, priority)
+
+def fan_out(message_id, lease, owner):
+    """
+    Stream matching devices in batches from the job's last device id and
+    enqueue them batch by batch, recording the position and progress on the
+    message's Redis hash. Stops if the lease was lost to another worker; a
+    batch interrupted by a crash may be enqueued twice.
+    """
+    key = f'message:{message_id}'
+    project_id, filters, after = redis_client.hmget(key, ['project_id', 'fanout_filters', 'fanout_after'])
+    if filters is None:
+        # The message payload expired before the job could finish
+        redis_client.zrem('fanout_jobs', message_id)
+        return
+    filters = json.loads(filters)
+    redis_client.hset(key, 'fanout_status', 'running')
+    with engine.connect() as conn:
+        columns = (Device.id, Device.platform, Device.token, Device.timezone)
+        for devices in device_batches(conn, project_id, filters, columns, after=int(after or 0)):
+            if redis_client.get(lease) != owner:
+                return
+            enqueued, _ = queue_device_tasks(message_id, devices, project_id, filters)
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hincrby(key, 'fanout_enqueued', enqueued)
+            pipe.hset(key, 'fanout_after', max(device.id for device in devices))
+            pipe.expire(lease, FANOUT_LEASE_TTL)
+            pipe.execute()
+    redis_client.hset(key, 'fanout_status', 'done')
+    redis_client.zrem('fanout_jobs', message_id)
+
+def fail_fan_out(message_id, error):
+    """Mark a fan-out job failed and drop it from fanout_jobs"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(f'message:{message_id}', mapping={'fanout_status': 'failed', 'fanout_error': error})
+    pipe.zrem('fanout_jobs', message_id)
+    pipe.execute()
+
+def run_fan_out_job(owner):
+    """
+    Lease a due fan-out job and run it. Jobs stay in the fanout_jobs sorted
+    set until done, so one whose worker died is resumed once its lease expires.
+    A job that fails on bad input, or FANOUT_MAX_ATTEMPTS times, is marked failed.
+
+    Returns:
+        Whether a job was run
+    """
+    for message_id in redis_client.zrangebyscore('fanout_jobs', '-inf', time.time(), start=0, num=10):
+        lease = f'fanout_lease:{message_id}'
+        if not redis_client.set(lease, owner, nx=True, ex=FANOUT_LEASE_TTL):
+            continue
+        try:
+            fan_out(message_id, lease, owner)
+        except (DataError, ValueError, TypeError) as e:
+            traceback.print_exc()
+            fail_fan_out(message_id, repr(e))
+        except Exception as e:
+            traceback.print_exc()
+            if redis_client.hincrby(f'message:{message_id}', 'fanout_attempts', 1) >= FANOUT_MAX_ATTEMPTS:
+                fail_fan_out(message_id, repr(e))
+            else:
+                redis_client.zadd('fanout_jobs', {message_id: time.time() + FANOUT_RETRY_DELAY})
+        finally:
+            if redis_client.get(lease) == owner:
+                redis_client.delete(lease)
+        return True
+    return False
+
+def start_fan_out(message_id, filters):
+    """Queue a durable fan-out job for the delivery worker"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(f'message:{message_id}', mapping={
+        'fanout_status': 'pending',
+        'fanout_enqueued': 0,
+        'fanout_after': 0,
+        'fanout_filters': json.dumps(filters)
+    })
+    pipe.zadd('fanout_jobs', {str(message_id): time.time()})
+    pipe.execute()
+
+def get_fan_out_progress(message_id):
+    """Return fan-out status and enqueued count, or None for synchronous sends"""
+    status, enqueued, error = redis_client.hmget(
+        f'message:{message_id}', ['fanout_status', 'fanout_enqueued', 'fanout_error']
+    )
+    if not status:
+        return None
+    progress = {'status': status, 'enqueued': int(enqueued or 0)}
+    if error:
+        progress['error'] = error
+    return progress
@@ -0,0 +1,84 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, Response, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from prometheus_client import (
+    Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+
+REQUEST_LATENCY = Histogram(
+    'push_api_request_seconds', 'Request latency by endpoint', ['endpoint', 'method', 'status']
+)
+PHASE_LATENCY = Histogram(
+    'push_api_phase_seconds', 'Time spent per request phase (auth, db, redis, serialize)', ['endpoint', 'phase']
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    'push_api_db_pool_checkout_seconds', 'Time waiting to check a connection out of the SQLAlchemy pool'
+)
+
+def record_phase(name, seconds):
+    """Add time to a phase of the current request (ignored outside requests)"""
+    if has_request_context():
+        phases = g.setdefault('phases', {})
+        phases[name] = phases.get(name, 0) + seconds
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that records response serialization time"""
+
+    def response(self, *args, **kwargs):
+        with phase('serialize'):
+            return super().response(*args, **kwargs)
+
+class QueueDepthCollector:
+    """Reads push queue depth from Redis at scrape time"""
+
+    def collect(self):
+        from app.queue import queue_depths
+        gauge = GaugeMetricFamily('push_api_queue_depth', 'Tasks waiting in the push queues', labels=['priority'])
+        for priority, depth in queue_depths().items():
+            gauge.add_metric([priority], depth)
+        yield gauge
+
+queue_registry = CollectorRegistry()
+queue_registry.register(QueueDepthCollector())
+
+def init_metrics(app):
+    """
+    Time every request by endpoint and phase and expose /metrics. Set
+    PROMETHEUS_MULTIPROC_DIR to aggregate across gunicorn worker processes.
+    """
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if 'request_start' in g:
+            endpoint = request.endpoint or 'unknown'
+            REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+                time.perf_counter() - g.request_start
+            )
+            for name, seconds in g.get('phases', {}).items():
+                PHASE_LATENCY.labels(endpoint, name).observe(seconds)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry) + generate_latest(queue_registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import asyncio
+from urllib.parse import urlsplit
+import httpx
+import http_ece
+from cryptography.hazmat.primitives.asymmetric import ec
+from app.utils.crypto import get_cached_credentials, b64url_decode
+
+# Provider endpoints are configurable so the worker can run against local stubs
+APNS_URL = os.environ.get('APNS_URL', 'https://api.push.apple.com')
+FCM_URL = os.environ.get('FCM_URL', 'https://fcm.googleapis.com')
+FCM_TOKEN_URL = os.environ.get('FCM_TOKEN_URL')
+WEBPUSH_URL = os.environ.get('WEBPUSH_URL')
+
+PROVIDER_MAX_CONNECTIONS = int(os.environ.get('PROVIDER_MAX_CONNECTIONS', 10))
+PROVIDER_TIMEOUT = float(os.environ.get('PROVIDER_TIMEOUT', 10))
+FCM_SCOPE = 'https://www.googleapis.com/auth/firebase.messaging'
+
+def is_dead_token(platform, response):
+    """Whether a provider response says the device token can never succeed"""
+    if platform == 'ios':
+        return response.status_code == 410 or (response.status_code == 400 and 'BadDeviceToken' in response.text)
+    elif platform == 'android':
+        return response.status_code == 404 and 'UNREGISTERED' in response.text
+    elif platform == 'web':
+        return response.status_code in (404, 410)
+    return False
+
+class ProviderPool:
+    """
+    Long-lived HTTP/2 clients per project and provider, shared by all
+    in-flight deliveries of a worker.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.fcm_tokens = {}
+        self.fcm_locks = {}
+
+    def client(self, project_id, platform):
+        key = (project_id, platform)
+        if key not in self.clients:
+            self.clients[key] = httpx.AsyncClient(
+                http2=True,
+                timeout=PROVIDER_TIMEOUT,
+                limits=httpx.Limits(max_connections=PROVIDER_MAX_CONNECTIONS)
+            )
+        return self.clients[key]
+
+    async def close(self):
+        await asyncio.gather(*(client.aclose() for client in self.clients.values()))
+
+    async def send(self, task, payload):
+        """Deliver one task and return the provider's response"""
+        credentials = get_cached_credentials(
+            payload['project_id'], payload['credentials_version'], payload['credentials']
+        )
+        client = self.client(payload['project_id'], task['platform'])
+
+        if task['platform'] == 'ios':
+            return await self.send_apns(client, credentials, task, payload)
+        elif task['platform'] == 'android':
+            return await self.send_fcm(client, credentials, task, payload)
+        elif task['platform'] == 'web':
+            return await self.send_web_push(client, credentials, task, payload)
+        raise ValueError(f"Unsupported platform: {task['platform']}")
+
+    async def send_apns(self, client, credentials, task, payload):
+        body = {'aps': {'alert': {'title': payload['title'], 'body': payload['body']}}}
+        if payload.get('action_url'):
+            body['action_url'] = payload['action_url']
+        headers = {
+            'authorization': f'bearer {credentials.apns_token()}',
+            'apns-topic': credentials['apns_bundle_id'],
+            'apns-push-type': 'alert'
+        }
+        if payload.get('collapse_key'):
+            headers['apns-collapse-id'] = payload['collapse_key']
+        return await client.post(f"{APNS_URL}/3/device/{task['token']}", json=body, headers=headers)
+
+    async def send_fcm(self, client, credentials, task, payload):
+        service_account = credentials.service_account
+        access_token = await self.fcm_access_token(client, credentials)
+        message = {
+            'token': task['token'],
+            'notification': {'title': payload['title'], 'body': payload['body']}
+        }
+        if payload.get('action_url'):
+            message['data'] = {'action_url': payload['action_url']}
+        if payload.get('collapse_key'):
+            message['android'] = {'collapse_key': payload['collapse_key']}
+        return await client.post(
+            f"{FCM_URL}/v1/projects/{service_account['project_id']}/messages:send",
+            json={'message': message},
+            headers={'authorization': f'Bearer {access_token}'}
+        )
+
+    async def fcm_access_token(self, client, credentials):
+        """Exchange the service account for an OAuth access token, cached until expiry"""
+        service_account = credentials.service_account
+        email = service_account['client_email']
+        lock = self.fcm_locks.setdefault(email, asyncio.Lock())
+        async with lock:
+            cached = self.fcm_tokens.get(email)
+            if cached and cached[1] > time.time() + 60:
+                return cached[0]
+
+            now = int(time.time())
+            response = await client.post(FCM_TOKEN_URL or service_account['token_uri'], data={
+                'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                'assertion': credentials.fcm_assertion(FCM_SCOPE)
+            })
+            response.raise_for_status()
+            token = response.json()
+            self.fcm_tokens[email] = (token['access_token'], now + token.get('expires_in', 3600))
+            return token['access_token']
+
+    async def send_web_push(self, client, credentials, task, payload):
+        # Tasks queued before the codec layer carry the subscription as a JSON string
+        subscription = task['token'] if isinstance(task['token'], dict) else json.loads(task['token'])
+        endpoint = WEBPUSH_URL or subscription['endpoint']
+        parts = urlsplit(endpoint)
+
+        # Encrypt the payload for the subscription (RFC 8291)
+        data = json.dumps({
+            'title': payload['title'],
+            'body': payload['body'],
+            'icon': payload.get('icon'),
+            'action_url': payload.get('action_url')
+        }).encode()
+        body = http_ece.encrypt(
+            data,
+            salt=os.urandom(16),
+            private_key=ec.generate_private_key(ec.SECP256R1()),
+            dh=b64url_decode(subscription['keys']['p256dh']),
+            auth_secret=b64url_decode(subscription['keys']['auth']),
+            version='aes128gcm'
+        )
+        headers = {
+            'authorization': f"vapid t={credentials.vapid_token(f'{parts.scheme}://{parts.netloc}')}, k={credentials['vapid_public_key']}",
+            'content-encoding': 'aes128gcm',
+            'ttl': '86400'
+        }
+        if payload.get('collapse_key'):
+            headers['topic'] = payload['collapse_key']
+        return await client.post(endpoint, content=body, headers=headers)
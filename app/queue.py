@@ -0,0 +1,480 @@
+import os
+import json
+import time
+import random
+import socket
+from redis.exceptions import ResponseError
+from app.redis import redis_client, redis_binary_client, QUEUE_BACKEND
+from app.utils.cache import TTLCache
+from app.utils import codec
+from app.metrics import phase
+
+ENQUEUE_CHUNK_SIZE = int(os.environ.get('ENQUEUE_CHUNK_SIZE', 1000))
+MESSAGE_PAYLOAD_TTL = int(os.environ.get('MESSAGE_PAYLOAD_TTL', 86400))
+QUEUE_QUANTUM = int(os.environ.get('QUEUE_QUANTUM', 100))
+STREAM_GROUP = os.environ.get('STREAM_GROUP', 'push_workers')
+STREAM_CLAIM_IDLE_MS = int(os.environ.get('STREAM_CLAIM_IDLE_MS', 60000))
+# Entries handed out this many times without an ack are dead-lettered on the next claim
+STREAM_MAX_DELIVERIES = int(os.environ.get('STREAM_MAX_DELIVERIES', 5))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 300))
+DEAD_LETTER_MAXLEN = int(os.environ.get('DEAD_LETTER_MAXLEN', 100000))
+SCHEDULE_DISPATCH_BATCH_SIZE = int(os.environ.get('SCHEDULE_DISPATCH_BATCH_SIZE', 1000))
+
+# Queue priorities, drained in this order within each project
+PRIORITIES = ['high', 'normal']
+
+MESSAGE_FIELDS = ['project_id', 'title', 'body', 'icon', 'action_url', 'collapse_key']
+CREDENTIAL_FIELDS = [
+    'apns_key_id', 'apns_team_id', 'apns_bundle_id', 'apns_private_key',
+    'fcm_credentials_json',
+    'vapid_public_key', 'vapid_private_key', 'vapid_subject'
+]
+
+# Worker-side cache of shared message payloads and credential snapshots
+_payload_cache = TTLCache(maxsize=10000, ttl=300)
+
+def credentials_version(project):
+    """Version a project's credentials by their last update time"""
+    updated_at = project.get('updated_at')
+    return str(int(updated_at.timestamp() * 1000000)) if updated_at else '0'
+
+# Write a credential snapshot unless it already lives at least ARGV[2] seconds,
+# so a short-lived send never cuts the TTL a scheduled message depends on
+_store_credentials = redis_client.register_script("""
+if redis.call('ttl', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+""")
+
+def store_message_payloads(messages, project, ttl=MESSAGE_PAYLOAD_TTL):
+    """
+    Store each message's content and a snapshot of the project's (still encrypted)
+    credentials once in Redis, so per-device tasks only need to reference them.
+    Scheduled messages pass a longer ttl so the payload outlives the wait.
+    """
+    version = credentials_version(project)
+    credentials = {field: project.get(field) for field in CREDENTIAL_FIELDS}
+
+    pipe = redis_client.pipeline(transaction=False)
+    for message in messages:
+        payload = {field: message[field] or '' for field in MESSAGE_FIELDS}
+        payload['project_id'] = str(payload['project_id'])
+        payload['credentials_version'] = version
+        pipe.hset(f"message:{message['id']}", mapping=payload)
+        pipe.expire(f"message:{message['id']}", ttl)
+    _store_credentials(
+        keys=[f"credentials:{payload['project_id']}:{version}"], args=[json.dumps(credentials), ttl], client=pipe
+    )
+    with phase('redis'):
+        pipe.execute()
+
+def store_message_payload(message, project, ttl=MESSAGE_PAYLOAD_TTL):
+    store_message_payloads([message], project, ttl)
+
+def load_message_payload(message_id):
+    """
+    Load a message payload with its credential snapshot, caching both locally.
+
+    Returns:
+        Dict of message fields plus 'credentials', or None if it has expired
+    """
+    payload = _payload_cache.get(f'message:{message_id}')
+    if payload:
+        return payload
+
+    stored = redis_client.hgetall(f'message:{message_id}')
+    if not stored:
+        return None
+    payload = {field: stored.get(field) or None for field in MESSAGE_FIELDS}
+    payload['credentials_version'] = stored.get('credentials_version', '0')
+
+    credentials_key = f"credentials:{payload['project_id']}:{payload['credentials_version']}"
+    credentials = _payload_cache.get(credentials_key)
+    if credentials is None:
+        credentials = json.loads(redis_client.get(credentials_key) or '{}')
+        _payload_cache.set(credentials_key, credentials)
+    payload['credentials'] = credentials
+
+    _payload_cache.set(f'message:{message_id}', payload)
+    return payload
+
+def queue_key(project_id, priority):
+    if QUEUE_BACKEND == 'stream':
+        return f'push_stream:{priority}:{project_id}'
+    return f'push_tasks:{priority}:{project_id}'
+
+def task_fields(task):
+    """A task without the worker's bookkeeping fields"""
+    return {field: value for field, value in task.items() if not field.startswith('_')}
+
+def encode_task(task):
+    return codec.encode(task_fields(task))
+
+def collapse_key_name(project_id, collapse_key):
+    return f'collapse:{project_id}:{collapse_key}'
+
+def enqueue_tasks(tasks, project_id, priority='normal', chunk_size=ENQUEUE_CHUNK_SIZE, count_queued=True):
+    """
+    Queue push tasks on the project's queue for a priority, all sent in a
+    single pipeline. The list backend uses one multi-value LPUSH per chunk,
+    the stream backend one XADD per task. Unless count_queued is False, each
+    message's live queued counter is bumped in the same pipeline. Tasks with a
+    collapse key get a sequence number when first queued and record it as the
+    newest for the device and key, so enqueue order (not message id) decides
+    which message supersedes which.
+
+    Returns:
+        Tuple of (number of tasks enqueued, elapsed milliseconds)
+    """
+    start = time.perf_counter()
+    fresh = [task for task in tasks if task.get('collapse_key') and 'collapse_seq' not in task]
+    if fresh:
+        # Retried tasks keep their number, so a newer message still supersedes them
+        seq = redis_client.incrby('collapse_seq', len(fresh)) - len(fresh)
+        for task in fresh:
+            seq += 1
+            task['collapse_seq'] = seq
+    key = queue_key(project_id, priority)
+    pipe = redis_client.pipeline(transaction=False)
+    count = 0
+    chunk = []
+    queued = {}
+    collapse_keys = set()
+    for task in tasks:
+        queued[task['message_id']] = queued.get(task['message_id'], 0) + 1
+        if task.get('collapse_key'):
+            collapse_key = collapse_key_name(project_id, task['collapse_key'])
+            pipe.zadd(collapse_key, {task['device_id']: task['collapse_seq']}, gt=True)
+            collapse_keys.add(collapse_key)
+        if QUEUE_BACKEND == 'stream':
+            pipe.xadd(key, {'task': encode_task(task)})
+            count += 1
+            continue
+        chunk.append(encode_task(task))
+        if len(chunk) >= chunk_size:
+            pipe.lpush(key, *chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        pipe.lpush(key, *chunk)
+        count += len(chunk)
+    for collapse_key in collapse_keys:
+        pipe.expire(collapse_key, MESSAGE_PAYLOAD_TTL)
+    if count_queued:
+        for message_id, message_count in queued.items():
+            pipe.hincrby(f'message:{message_id}', 'queued', message_count)
+    if count:
+        pipe.sadd(f'push_queues:{priority}', str(project_id))
+        if QUEUE_BACKEND == 'stream':
+            # Every stream ever used, so pending entries can always be reclaimed
+            pipe.sadd(f'push_streams:{priority}', str(project_id))
+    with phase('redis'):
+        pipe.execute()
+    return count, round((time.perf_counter() - start) * 1000, 2)
+
+def superseded_tasks(tasks):
+    """
+    Tasks whose device has since been queued another message with the same
+    collapse key, looked up in one pipeline
+    """
+    collapsible = [task for task in tasks if task.get('collapse_key')]
+    if not collapsible:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for task in collapsible:
+        pipe.zscore(collapse_key_name(task['_queue'][0], task['collapse_key']), task['device_id'])
+    return [
+        task for task, latest in zip(collapsible, pipe.execute())
+        if latest and latest > task['collapse_seq']
+    ]
+
+# Deactivate a project queue only if it has nothing left to hand out, so a
+# concurrent enqueue can never leave a non-empty queue out of the active set
+_deactivate_if_empty = redis_client.register_script("""
+local waiting
+if ARGV[2] == 'stream' then
+    waiting = redis.call('xlen', KEYS[1])
+    if waiting > 0 then
+        waiting = waiting - redis.call('xpending', KEYS[1], ARGV[3])[1]
+    end
+else
+    waiting = redis.call('llen', KEYS[1])
+end
+if waiting == 0 then
+    return redis.call('srem', KEYS[2], ARGV[1])
+end
+return 0
+""")
+
+# Atomically take up to ARGV[2] entries due by ARGV[1] from a timer sorted set.
+# The score range read only touches due entries, however many are waiting.
+_pop_due = redis_binary_client.register_script("""
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+end
+return due
+""")
+
+def queue_depths():
+    """Total queued tasks per priority"""
+    depths = {}
+    for priority in PRIORITIES:
+        projects = redis_client.smembers(f'push_queues:{priority}')
+        pipe = redis_client.pipeline(transaction=False)
+        for project_id in projects:
+            if QUEUE_BACKEND == 'stream':
+                pipe.xlen(queue_key(project_id, priority))
+            else:
+                pipe.llen(queue_key(project_id, priority))
+        depths[priority] = sum(pipe.execute()) if projects else 0
+    return depths
+
+def complete_tasks(done, retries, deferred=()):
+    """
+    Acknowledge finished tasks and schedule retries with exponential backoff,
+    moving tasks out of attempts to the dead-letter stream. One round trip.
+
+    Args:
+        done: Tasks that are finished (delivered, failed for good, retried or deferred)
+        retries: (task, error, retry_after) tuples to try again later; the
+            backoff is at least the provider's Retry-After when given
+        deferred: (task, delay) pairs handed back because of provider
+            throttling; they are retried without using up an attempt
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for task, delay in deferred:
+        project_id, priority = task['_queue']
+        entry = codec.encode({'project_id': project_id, 'priority': priority, 'task': task_fields(task)})
+        pipe.zadd('push_retry', {entry: time.time() + delay * random.uniform(1, 1.2)})
+    for task, error, retry_after in retries:
+        attempts = task.get('attempts', 0) + 1
+        project_id, priority = task['_queue']
+        if attempts > RETRY_MAX_ATTEMPTS:
+            pipe.xadd('push_dead_letter', {
+                'task': encode_task(task), 'project_id': project_id, 'error': str(error)
+            }, maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+            continue
+        delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+        retry = codec.encode({
+            'project_id': project_id,
+            'priority': priority,
+            'task': {**task_fields(task), 'attempts': attempts}
+        })
+        delay *= random.uniform(0.5, 1)
+        if retry_after:
+            delay = max(delay, retry_after)
+        pipe.zadd('push_retry', {retry: time.time() + delay})
+
+    # Stream entries are acked and deleted so streams only hold live work
+    acks = {}
+    for task in done:
+        if '_id' in task:
+            acks.setdefault(queue_key(*task['_queue']), []).append(task['_id'])
+    for key, ids in acks.items():
+        pipe.xack(key, STREAM_GROUP, *ids)
+        pipe.xdel(key, *ids)
+    if retries or deferred or acks:
+        pipe.execute()
+
+def schedule_tasks(scheduled, project_id, priority='normal'):
+    """
+    Hold tasks in the push_scheduled sorted set, scored by due time, until the
+    dispatcher moves them onto their queue. Messages' queued counters are
+    bumped now, in the same pipeline.
+
+    Args:
+        scheduled: (task, due unix timestamp) pairs
+
+    Returns:
+        Tuple of (number of tasks scheduled, elapsed milliseconds)
+    """
+    start = time.perf_counter()
+    pipe = redis_client.pipeline(transaction=False)
+    entries = {}
+    queued = {}
+    for task, due in scheduled:
+        queued[task['message_id']] = queued.get(task['message_id'], 0) + 1
+        entries[codec.encode({'project_id': project_id, 'priority': priority, 'task': task_fields(task)})] = due
+        if len(entries) >= ENQUEUE_CHUNK_SIZE:
+            pipe.zadd('push_scheduled', entries)
+            entries = {}
+    if entries:
+        pipe.zadd('push_scheduled', entries)
+    for message_id, message_count in queued.items():
+        pipe.hincrby(f'message:{message_id}', 'queued', message_count)
+    with phase('redis'):
+        pipe.execute()
+    return sum(queued.values()), round((time.perf_counter() - start) * 1000, 2)
+
+def requeue_due(key, limit):
+    """Move due entries of a timer sorted set onto their project queues"""
+    due = _pop_due(keys=[key], args=[time.time(), limit])
+    queues = {}
+    for entry in due:
+        entry = codec.decode(entry)
+        queues.setdefault((entry['project_id'], entry['priority']), []).append(entry['task'])
+    for (project_id, priority), tasks in queues.items():
+        enqueue_tasks(tasks, project_id, priority, count_queued=False)
+    return len(due)
+
+def requeue_due_retries(limit=ENQUEUE_CHUNK_SIZE):
+    """Move retries whose backoff has elapsed back onto their queues"""
+    return requeue_due('push_retry', limit)
+
+def dispatch_scheduled_tasks(limit=SCHEDULE_DISPATCH_BATCH_SIZE):
+    """Move a batch of scheduled tasks that are due onto their queues"""
+    return requeue_due('push_scheduled', limit)
+
+class FairScheduler:
+    """
+    Drains per-project queues with deficit round-robin, so a large broadcast
+    cannot starve other projects. Fairness applies across projects first: a
+    project's credit is spent on its high queue before its normal one, so
+    marking a broadcast high only reorders that project's own traffic.
+    Project weights are read from the queue_weights Redis hash (default and minimum 1).
+
+    With the stream backend, tasks are read through a consumer group and must
+    be acknowledged with complete_tasks; entries left pending by a dead
+    consumer are claimed after STREAM_CLAIM_IDLE_MS. Tasks are read with the
+    binary client and decoded by their codec format byte.
+    """
+
+    def __init__(self, quantum=QUEUE_QUANTUM, consumer=None):
+        self.quantum = quantum
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.deficits = {}
+        self.groups = set()
+        self.last_claim = 0
+
+    def ensure_group(self, key):
+        if key in self.groups:
+            return
+        try:
+            redis_client.xgroup_create(key, STREAM_GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.groups.add(key)
+
+    def read(self, pipe, key, size):
+        if QUEUE_BACKEND == 'stream':
+            self.ensure_group(key)
+            pipe.xreadgroup(STREAM_GROUP, self.consumer, {key: '>'}, count=size)
+        else:
+            pipe.rpop(key, size)
+
+    def parse(self, result, project_id, priority):
+        if QUEUE_BACKEND == 'stream':
+            entries = result[0][1] if result else []
+            return [
+                {**codec.decode(fields[b'task']), '_id': entry_id, '_queue': (project_id, priority)}
+                for entry_id, fields in entries
+            ]
+        return [{**codec.decode(task), '_queue': (project_id, priority)} for task in result or []]
+
+    def claim(self, count):
+        """
+        Claim up to count stream entries idle for too long on dead consumers.
+        Entries already delivered STREAM_MAX_DELIVERIES times (e.g. a task
+        that crashes the worker) go to the dead-letter stream instead.
+        """
+        tasks = []
+        for priority in PRIORITIES:
+            for project_id in redis_client.smembers(f'push_streams:{priority}'):
+                if len(tasks) >= count:
+                    return tasks
+                key = queue_key(project_id, priority)
+                self.ensure_group(key)
+                pending = redis_binary_client.xpending_range(
+                    key, STREAM_GROUP, min='-', max='+', count=count - len(tasks), idle=STREAM_CLAIM_IDLE_MS
+                )
+                if not pending:
+                    continue
+                deliveries = {entry['message_id']: entry['times_delivered'] for entry in pending}
+                entries = redis_binary_client.xclaim(
+                    key, STREAM_GROUP, self.consumer, STREAM_CLAIM_IDLE_MS, list(deliveries)
+                )
+                entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+                poisoned = [
+                    (entry_id, fields) for entry_id, fields in entries
+                    if deliveries.get(entry_id, 0) >= STREAM_MAX_DELIVERIES
+                ]
+                if poisoned:
+                    pipe = redis_client.pipeline(transaction=False)
+                    for entry_id, fields in poisoned:
+                        pipe.xadd('push_dead_letter', {
+                            'task': fields[b'task'],
+                            'project_id': project_id,
+                            'error': f'Not acknowledged after {deliveries[entry_id]} deliveries'
+                        }, maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+                    ids = [entry_id for entry_id, _ in poisoned]
+                    pipe.xack(key, STREAM_GROUP, *ids)
+                    pipe.xdel(key, *ids)
+                    pipe.execute()
+                    entries = [(entry_id, fields) for entry_id, fields in entries if entry_id not in ids]
+                tasks.extend(self.parse([[key, entries]], project_id, priority))
+        return tasks
+
+    def pop(self, count, skip=()):
+        """Pop up to count tasks across all active queues, except the skipped projects'"""
+        tasks = []
+        if QUEUE_BACKEND == 'stream' and time.time() - self.last_claim > STREAM_CLAIM_IDLE_MS / 1000:
+            self.last_claim = time.time()
+            tasks.extend(self.claim(count))
+
+        pipe = redis_client.pipeline(transaction=False)
+        for priority in PRIORITIES:
+            pipe.smembers(f'push_queues:{priority}')
+        pipe.hgetall('queue_weights')
+        *active, weights = pipe.execute()
+        active = {priority: projects - set(skip) for priority, projects in zip(PRIORITIES, active)}
+        projects = set().union(*active.values())
+
+        while projects and len(tasks) < count:
+            # One DRR round: each visited project earns quantum * weight credit
+            # and pops up to its credit, within what is left of the batch
+            order = list(projects)
+            random.shuffle(order)
+            budget = count - len(tasks)
+            sizes = {}
+            for project_id in order:
+                if budget <= 0:
+                    break
+                credit = self.quantum * max(int(weights.get(project_id, 1)), 1)
+                self.deficits[project_id] = min(self.deficits.get(project_id, 0) + credit, 2 * credit)
+                sizes[project_id] = min(self.deficits[project_id], budget)
+                budget -= sizes[project_id]
+
+            # Each project spends its credit on its own queues in priority order
+            for priority in PRIORITIES:
+                reads = []
+                pipe = redis_binary_client.pipeline(transaction=False)
+                for project_id, size in sizes.items():
+                    if size > 0 and project_id in active[priority]:
+                        key = queue_key(project_id, priority)
+                        self.read(pipe, key, size)
+                        reads.append((project_id, key, size))
+                if not reads:
+                    continue
+
+                for (project_id, key, size), result in zip(reads, pipe.execute()):
+                    popped = self.parse(result, project_id, priority)
+                    tasks.extend(popped)
+                    self.deficits[project_id] -= len(popped)
+                    sizes[project_id] -= len(popped)
+                    if len(popped) < size:
+                        # Queue drained: deactivate it
+                        _deactivate_if_empty(
+                            keys=[key, f'push_queues:{priority}'],
+                            args=[project_id, QUEUE_BACKEND, STREAM_GROUP]
+                        )
+                        active[priority].discard(project_id)
+
+            projects = set().union(*active.values())
+            for project_id in set(sizes) - projects:
+                # Every queue of the project drained: drop its credit
+                self.deficits.pop(project_id, None)
+        return tasks
@@ -7,4 +7,10 @@ load_dotenv()
 redis_client = redis.Redis.from_url(
     os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
     decode_responses=True
-) 
\ No newline at end of file
+)
+
+# Raw bytes, for reading binary-encoded queue payloads
+redis_binary_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+# Push queue backend: 'list' (LPUSH/RPOP) or 'stream' (consumer groups with acks)
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'list')
@@ -0,0 +1,46 @@
+from sqlalchemy import any_, literal, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.db.models import Device
+from app.redis import redis_client
+
+def topic_key(project_id, topic):
+    return f'topic:{project_id}:{topic}'
+
+def subscribe(project_id, devices):
+    """Add (device_id, topics) pairs to their topics' member sets"""
+    pipe = redis_client.pipeline(transaction=False)
+    for device_id, topics in devices:
+        for topic in topics or []:
+            # Scored by device id so members can be paged without duplicates
+            pipe.zadd(topic_key(project_id, topic), {str(device_id): int(device_id)})
+    pipe.execute()
+
+def unsubscribe(project_id, device_id, topics):
+    pipe = redis_client.pipeline(transaction=False)
+    for topic in topics or []:
+        pipe.zrem(topic_key(project_id, topic), str(device_id))
+    pipe.execute()
+
+def topic_page_query(query, topic, device_ids):
+    """Narrow a device query to one page of a topic's members"""
+    return query.where(
+        Device.id == any_(literal([int(device_id) for device_id in device_ids], ARRAY(BigInteger))),
+        Device.topics.any(topic)
+    )
+
+def topic_device_batches(conn, query, project_id, topic, batch_size, after=0):
+    """
+    Page through a topic's members in Redis by device id, starting above
+    after, and load each page's devices by primary key, re-checking the
+    subscription in Postgres.
+    """
+    key = topic_key(project_id, topic)
+    after = f'({after}' if after else '-inf'
+    while True:
+        device_ids = redis_client.zrangebyscore(key, after, '+inf', start=0, num=batch_size)
+        if not device_ids:
+            return
+        devices = conn.execute(topic_page_query(query, topic, device_ids)).fetchall()
+        if devices:
+            yield devices
+        after = f'({device_ids[-1]}'
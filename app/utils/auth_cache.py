@@ -0,0 +1,50 @@
+import os
+import hashlib
+from sqlalchemy import select
+from app.database import engine
+from app.db.models import Project
+from app.redis import redis_client
+from app.utils.cache import TTLCache
+
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 300))
+AUTH_LOCAL_TTL = int(os.environ.get('AUTH_LOCAL_TTL', 30))
+AUTH_NEGATIVE_TTL = int(os.environ.get('AUTH_NEGATIVE_TTL', 5))
+
+# First tier: per-process api_key -> project_id ('' marks an invalid key)
+_local_cache = TTLCache(maxsize=10000, ttl=AUTH_LOCAL_TTL)
+
+def _cache_key(api_key):
+    return 'auth:' + hashlib.sha256(api_key.encode()).hexdigest()
+
+def get_project_id(api_key):
+    """
+    Resolve an API key to its project ID, checking the local cache, then Redis,
+    and only then Postgres.
+
+    Returns:
+        The project ID, or None if the key is invalid
+    """
+    key = _cache_key(api_key)
+    project_id = _local_cache.get(key)
+    if project_id is not None:
+        return project_id or None
+
+    project_id = redis_client.get(key)
+    if project_id is None:
+        with engine.connect() as conn:
+            project_id = conn.execute(
+                select(Project.id).where(Project.api_key == api_key)
+            ).scalar() or ''
+        redis_client.set(key, project_id, ex=AUTH_CACHE_TTL if project_id else AUTH_NEGATIVE_TTL)
+
+    _local_cache.set(key, project_id, ttl=AUTH_LOCAL_TTL if project_id else AUTH_NEGATIVE_TTL)
+    return project_id or None
+
+def invalidate_api_key(api_key):
+    """
+    Drop cached entries for an API key. Other processes' local entries expire
+    within AUTH_LOCAL_TTL.
+    """
+    key = _cache_key(api_key)
+    _local_cache.delete(key)
+    redis_client.delete(key)
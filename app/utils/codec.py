@@ -0,0 +1,28 @@
+import os
+import orjson
+import msgpack
+
+# Every encoded queue payload starts with a format byte, so the encoding can
+# change without draining the queues. Payloads from before the codec layer
+# are bare JSON and start with '{'.
+FORMAT_JSON = b'\x01'
+FORMAT_MSGPACK = b'\x02'
+
+QUEUE_CODEC = os.environ.get('QUEUE_CODEC', 'msgpack')
+
+def encode(data, codec=QUEUE_CODEC):
+    """Encode a queue payload as 'json' (orjson) or 'msgpack'"""
+    if codec == 'msgpack':
+        return FORMAT_MSGPACK + msgpack.packb(data)
+    elif codec == 'json':
+        return FORMAT_JSON + orjson.dumps(data)
+    raise ValueError(f'Unsupported queue codec: {codec}')
+
+def decode(payload):
+    """Decode a queue payload in any supported format"""
+    format = payload[:1]
+    if format == FORMAT_MSGPACK:
+        return msgpack.unpackb(payload[1:])
+    elif format == FORMAT_JSON:
+        return orjson.loads(payload[1:])
+    return orjson.loads(payload)
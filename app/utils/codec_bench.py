@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of queue payload encodings on realistic push tasks.
+
+    python -m app.utils.codec_bench [iterations]
+"""
+import sys
+import json
+import time
+import secrets
+from app.utils import codec
+
+def sample_tasks():
+    """One task per platform, shaped like what fan-out queues"""
+    subscription = {
+        'endpoint': f'https://fcm.googleapis.com/fcm/send/{secrets.token_urlsafe(120)}',
+        'keys': {'p256dh': secrets.token_urlsafe(65), 'auth': secrets.token_urlsafe(16)}
+    }
+    return [
+        {'message_id': '184467440737', 'device_id': '90071992547', 'platform': 'ios', 'token': secrets.token_hex(32)},
+        {'message_id': '184467440737', 'device_id': '90071992548', 'platform': 'android', 'token': secrets.token_urlsafe(122)},
+        {'message_id': '184467440737', 'device_id': '90071992549', 'platform': 'web', 'token': subscription},
+    ]
+
+def legacy_encode(task):
+    """Before the codec layer: stdlib JSON with the subscription double-encoded"""
+    if task['platform'] == 'web':
+        task = {**task, 'token': json.dumps(task['token'])}
+    return json.dumps(task)
+
+def legacy_decode(payload):
+    task = json.loads(payload)
+    if task['platform'] == 'web':
+        task['token'] = json.loads(task['token'])
+    return task
+
+def bench(encode, decode, tasks, iterations):
+    """Mean encode/decode microseconds and payload bytes per task"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        payloads = [encode(task) for task in tasks]
+    encoded = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for payload in payloads:
+            decode(payload)
+    decoded = time.perf_counter() - start
+    total = iterations * len(tasks)
+    return encoded / total * 1e6, decoded / total * 1e6, sum(len(payload) for payload in payloads) / len(tasks)
+
+def main(iterations=100000):
+    tasks = sample_tasks()
+    encodings = {
+        'legacy (stdlib json)': (legacy_encode, legacy_decode),
+        'json (orjson)': (lambda task: codec.encode(task, 'json'), codec.decode),
+        'msgpack': (lambda task: codec.encode(task, 'msgpack'), codec.decode),
+    }
+    print(f"{'encoding':<22}{'encode us':>12}{'decode us':>12}{'bytes':>10}")
+    for name, (encode, decode) in encodings.items():
+        encode_us, decode_us, size = bench(encode, decode, tasks, iterations)
+        print(f'{name:<22}{encode_us:>12.2f}{decode_us:>12.2f}{size:>10.0f}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
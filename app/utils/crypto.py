@@ -1,6 +1,13 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 import os
+import json
+import time
+import base64
+import jwt
 from typing import Optional, Dict, Any
+from app.utils.cache import TTLCache
 
 # Get encryption key from environment
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY')
@@ -55,6 +62,7 @@ def get_project_push_credentials(project_id: str) -> Dict[str, Any]:
     from app.database import engine
     from sqlalchemy import select
     from app.db.models import Project
+    from app.queue import credentials_version
     
     with engine.connect() as conn:
         # Fetch project with credentials
@@ -68,5 +76,108 @@ def get_project_push_credentials(project_id: str) -> Dict[str, Any]:
         # Convert to dict for easier handling
         project_dict = dict(project._mapping)
         
-        # Decrypt credentials
-        return decrypt_project_credentials(project_dict) 
\ No newline at end of file
+        # Decrypt credentials (cached per credential version)
+        return get_cached_credentials(project_id, credentials_version(project_dict), project_dict).credentials
+
+CREDENTIAL_CACHE_TTL = int(os.environ.get('CREDENTIAL_CACHE_TTL', 3600))
+CREDENTIAL_CACHE_SIZE = int(os.environ.get('CREDENTIAL_CACHE_SIZE', 1000))
+APNS_TOKEN_TTL = 50 * 60  # APNs rejects provider tokens older than an hour
+VAPID_TOKEN_TTL = 12 * 3600
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def load_ec_private_key(value: str):
+    """Load a PEM or raw base64url (web-push style) P-256 private key"""
+    if value.strip().startswith('-----BEGIN'):
+        return serialization.load_pem_private_key(value.encode(), password=None)
+    return ec.derive_private_key(int.from_bytes(b64url_decode(value), 'big'), ec.SECP256R1())
+
+class ProjectCredentials:
+    """
+    Decrypted credentials for one project credential version, holding parsed
+    private keys and signed tokens so they can be reused across pushes.
+    """
+
+    def __init__(self, credentials: Dict[str, Any]):
+        self.credentials = decrypt_project_credentials(credentials)
+        self._keys = {}
+        self._tokens = {}
+
+    def __getitem__(self, field: str):
+        return self.credentials[field]
+
+    def _key(self, name: str, load):
+        if name not in self._keys:
+            self._keys[name] = load()
+        return self._keys[name]
+
+    def _token(self, name: str, ttl: int, sign) -> str:
+        cached = self._tokens.get(name)
+        if cached and cached[1] > time.time() + TOKEN_REFRESH_MARGIN:
+            return cached[0]
+        now = int(time.time())
+        token = sign(now, now + ttl)
+        self._tokens[name] = (token, now + ttl)
+        return token
+
+    @property
+    def service_account(self) -> Dict[str, Any]:
+        return self._key('fcm', lambda: json.loads(self.credentials['fcm_credentials_json']))
+
+    def fcm_assertion(self, scope: str) -> str:
+        """Sign the OAuth assertion for the FCM service account"""
+        service_account = self.service_account
+        key = self._key('fcm_private_key', lambda: serialization.load_pem_private_key(
+            service_account['private_key'].encode(), password=None
+        ))
+        now = int(time.time())
+        return jwt.encode(
+            {'iss': service_account['client_email'], 'scope': scope, 'aud': service_account['token_uri'], 'iat': now, 'exp': now + 3600},
+            key,
+            algorithm='RS256'
+        )
+
+    def apns_token(self) -> str:
+        """APNs provider token, reused until close to expiry"""
+        key = self._key('apns', lambda: serialization.load_pem_private_key(
+            self.credentials['apns_private_key'].encode(), password=None
+        ))
+        return self._token('apns', APNS_TOKEN_TTL, lambda iat, exp: jwt.encode(
+            {'iss': self.credentials['apns_team_id'], 'iat': iat},
+            key,
+            algorithm='ES256',
+            headers={'kid': self.credentials['apns_key_id']}
+        ))
+
+    def vapid_token(self, audience: str) -> str:
+        """VAPID JWT for a push service origin, reused until close to expiry"""
+        key = self._key('vapid', lambda: load_ec_private_key(self.credentials['vapid_private_key']))
+        return self._token(f'vapid:{audience}', VAPID_TOKEN_TTL, lambda iat, exp: jwt.encode(
+            {'aud': audience, 'exp': exp, 'sub': self.credentials['vapid_subject']},
+            key,
+            algorithm='ES256'
+        ))
+
+_credential_cache = TTLCache(maxsize=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+
+def get_cached_credentials(project_id: str, version: str, credentials: Dict[str, Any]) -> ProjectCredentials:
+    """
+    Get decrypted credentials for a project credential version, decrypting
+    them only on a cache miss.
+
+    Args:
+        project_id: The ID of the project
+        version: The credential version (see app.queue.credentials_version)
+        credentials: The encrypted credential snapshot
+
+    Returns:
+        ProjectCredentials for that version
+    """
+    key = (project_id, version)
+    cached = _credential_cache.get(key)
+    if cached is None:
+        cached = ProjectCredentials(credentials)
+        _credential_cache.set(key, cached)
+    return cached
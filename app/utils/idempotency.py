@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import hashlib
+from functools import wraps
+from flask import Response, g, jsonify, make_response, request
+from app.redis import redis_client
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_LOCK_TTL = int(os.environ.get('IDEMPOTENCY_LOCK_TTL', 300))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 30))
+
+PENDING = 'pending'
+
+def replay(stored, fingerprint):
+    record = json.loads(stored)
+    if record['fingerprint'] != fingerprint:
+        return jsonify({'error': 'Idempotency-Key was already used with a different request body'}), 422
+    response = Response(record['body'], status=record['status'], mimetype=record['mimetype'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(f):
+    """
+    Honor an Idempotency-Key header: the first request with a key runs and its
+    response is stored in Redis; retries get that stored response, and
+    concurrent duplicates wait for the first one to finish.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return f(*args, **kwargs)
+
+        key = f'idempotency:{g.project_id}:{idempotency_key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        # Claim the key, or wait for the request holding it
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        delay = 0.05
+        while not redis_client.set(key, PENDING, nx=True, ex=IDEMPOTENCY_LOCK_TTL):
+            stored = redis_client.get(key)
+            if stored and stored != PENDING:
+                return replay(stored, fingerprint)
+            if time.monotonic() > deadline:
+                return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            redis_client.delete(key)
+            raise
+
+        # Keep the response unless it failed on our side, so it can be retried
+        if response.status_code >= 500:
+            redis_client.delete(key)
+        else:
+            redis_client.set(key, json.dumps({
+                'fingerprint': fingerprint,
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'body': response.get_data(as_text=True)
+            }), ex=IDEMPOTENCY_TTL)
+        return response
+    return decorated_function
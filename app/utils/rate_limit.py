@@ -0,0 +1,94 @@
+import os
+import math
+import time
+from sqlalchemy import select
+from app.database import engine
+from app.db.models import Project
+from app.redis import redis_client
+
+# Projects are unlimited unless a default rate is set or an admin opts them in
+RATE_LIMIT_DEFAULT_RATE = float(os.environ.get('RATE_LIMIT_DEFAULT_RATE', 0))
+RATE_LIMIT_DEFAULT_BURST = int(os.environ.get('RATE_LIMIT_DEFAULT_BURST', 200))
+
+# Token bucket per project and endpoint. The project's limits are read from
+# its rate_limits hash (endpoint -> "rate:burst") in the same round trip.
+# Returns {allowed, burst, remaining, retry_after_ms}, or {1} when the rate is 0
+# (unlimited). Returns {-1} when the hash is missing and must be reloaded from Postgres.
+_token_bucket = redis_client.register_script("""
+if redis.call('exists', KEYS[2]) == 0 then
+    return {-1}
+end
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local config = redis.call('hget', KEYS[2], ARGV[1])
+if config then
+    local sep = string.find(config, ':')
+    rate = tonumber(string.sub(config, 1, sep - 1))
+    burst = tonumber(string.sub(config, sep + 1))
+end
+if rate <= 0 then
+    return {1}
+end
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) / 1000 * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('pexpire', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, burst, math.floor(tokens), retry_after}
+""")
+
+def check_rate_limit(project_id, endpoint):
+    """
+    Take one token from the project's bucket for an endpoint.
+
+    Returns:
+        Tuple of (allowed, headers) where headers carry the rate-limit state
+    """
+    keys = [f'rate_limit:{project_id}:{endpoint}', f'rate_limits:{project_id}']
+    args = [endpoint, RATE_LIMIT_DEFAULT_RATE, RATE_LIMIT_DEFAULT_BURST, int(time.time() * 1000)]
+    result = _token_bucket(keys=keys, args=args)
+    if result[0] == -1:
+        load_rate_limits(project_id)
+        result = _token_bucket(keys=keys, args=args)
+    if len(result) == 1:
+        return True, {}
+    allowed, burst, remaining, retry_after = result
+    headers = {'X-RateLimit-Limit': str(burst), 'X-RateLimit-Remaining': str(remaining)}
+    if not allowed:
+        headers['Retry-After'] = str(max(1, math.ceil(retry_after / 1000)))
+    return bool(allowed), headers
+
+def load_rate_limits(project_id):
+    """Repopulate a project's limits in Redis from projects.rate_limits"""
+    with engine.connect() as conn:
+        limits = conn.execute(select(Project.rate_limits).where(Project.id == project_id)).scalar()
+    set_rate_limits(project_id, limits)
+
+def set_rate_limits(project_id, limits):
+    """
+    Replace a project's limits in Redis. The hash always holds a _loaded
+    marker, so a missing hash means Redis lost it and it must be reloaded.
+
+    Args:
+        project_id: The ID of the project
+        limits: Dict of endpoint -> {'rate': tokens per second, 'burst': bucket size}
+    """
+    pipe = redis_client.pipeline()
+    pipe.delete(f'rate_limits:{project_id}')
+    pipe.hset(f'rate_limits:{project_id}', mapping={
+        '_loaded': 1,
+        **{endpoint: f"{float(limit['rate'])}:{int(limit['burst'])}" for endpoint, limit in (limits or {}).items()}
+    })
+    pipe.execute()
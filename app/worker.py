@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import traceback
+import httpx
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+from app.queue import (
+    FairScheduler, load_message_payload, complete_tasks, requeue_due_retries, dispatch_scheduled_tasks,
+    superseded_tasks, RETRY_MAX_ATTEMPTS
+)
+from app.deliveries import record_deliveries, report_invalid_devices, prune_invalid_devices
+from app.fanout import run_fan_out_job
+from app.providers import ProviderPool, is_dead_token
+from app.egress import EgressController, is_throttled, EGRESS_DEFER_DELAY
+
+load_dotenv()
+
+WORKER_BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', 500))
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 1000))
+WORKER_IDLE_SLEEP = float(os.environ.get('WORKER_IDLE_SLEEP', 0.5))
+DELIVERY_FLUSH_SIZE = int(os.environ.get('DELIVERY_FLUSH_SIZE', 1000))
+DELIVERY_FLUSH_INTERVAL = float(os.environ.get('DELIVERY_FLUSH_INTERVAL', 1))
+INVALID_DEVICE_PRUNE_INTERVAL = float(os.environ.get('INVALID_DEVICE_PRUNE_INTERVAL', 30))
+WORKER_METRICS_PORT = os.environ.get('WORKER_METRICS_PORT')
+
+class Worker:
+    """Drains the project queues, delivering up to WORKER_CONCURRENCY pushes at once"""
+
+    def __init__(self):
+        self.scheduler = FairScheduler()
+        self.pool = ProviderPool()
+        self.egress = EgressController()
+        self.semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+        self.in_flight = set()
+        self.done = []
+        self.retries = []
+        self.deferred = []
+        self.results = []
+        self.dead_devices = set()
+        self.last_flush = time.monotonic()
+        self.last_prune = time.monotonic()
+
+    def result(self, task, payload, status, status_code=None, error=None):
+        """Buffer a final delivery outcome"""
+        self.results.append({
+            'project_id': task['_queue'][0],
+            'message_id': int(task['message_id']),
+            'device_id': int(task['device_id']),
+            'status': status,
+            'status_code': status_code,
+            'error': error
+        })
+
+    def retry(self, task, payload, status_code, error, retry_after=None):
+        """Retry a transient failure, recording it as failed once out of attempts"""
+        self.retries.append((task, error, retry_after))
+        if task.get('attempts', 0) + 1 > RETRY_MAX_ATTEMPTS:
+            self.result(task, payload, 'failed', status_code, error)
+
+    def defer(self, task, delay):
+        """Hand a throttled task back to the queue without using up an attempt"""
+        self.deferred.append((task, delay))
+
+    async def deliver(self, task, payload):
+        try:
+            if payload is None:
+                self.result(task, payload, 'failed', error='Message payload expired')
+                return
+            if task.get('_superseded'):
+                self.result(task, payload, 'collapsed')
+                return
+            response, retry_after = await self.egress.send(self.pool.send, task, payload)
+            if is_throttled(task['platform'], response):
+                self.defer(task, retry_after or EGRESS_DEFER_DELAY)
+            elif response.status_code >= 500:
+                self.retry(task, payload, response.status_code, response.text, retry_after)
+            elif response.status_code >= 300:
+                if is_dead_token(task['platform'], response):
+                    self.dead_devices.add(task['device_id'])
+                self.result(task, payload, 'failed', response.status_code, response.text)
+            else:
+                self.result(task, payload, 'sent', response.status_code)
+        except httpx.TransportError as e:
+            self.retry(task, payload, None, repr(e))
+        except Exception as e:
+            traceback.print_exc()
+            self.result(task, payload, 'failed', None, repr(e))
+        finally:
+            self.done.append(task)
+            self.semaphore.release()
+
+    def take(self, force=False):
+        """Take finished work to complete, flushing results by size or interval"""
+        done, retries, deferred = self.done[:], self.retries[:], self.deferred[:]
+        self.done.clear()
+        self.retries.clear()
+        self.deferred.clear()
+        dead_devices = list(self.dead_devices)
+        self.dead_devices.clear()
+        results = []
+        if force or len(self.results) >= DELIVERY_FLUSH_SIZE or time.monotonic() - self.last_flush > DELIVERY_FLUSH_INTERVAL:
+            results = self.results[:]
+            self.results.clear()
+            self.last_flush = time.monotonic()
+        return done, retries, deferred, results, dead_devices
+
+    def finish(self, done, retries, deferred, results, dead_devices):
+        """Record results, report dead tokens and ack finished tasks"""
+        record_deliveries(results)
+        report_invalid_devices(dead_devices)
+        complete_tasks(done, retries, deferred)
+
+    def next_batch(self, finished, skip):
+        """
+        Finish completed work, requeue due retries and scheduled tasks and
+        periodically tombstone dead tokens, then pop a batch of tasks (except
+        for skipped projects whose credentials are all throttled), mark the
+        ones a later-queued message has collapsed and attach their (cached) message
+        payloads
+        """
+        self.finish(*finished)
+        requeue_due_retries()
+        dispatch_scheduled_tasks()
+        if time.monotonic() - self.last_prune > INVALID_DEVICE_PRUNE_INTERVAL:
+            self.last_prune = time.monotonic()
+            prune_invalid_devices()
+        tasks = self.scheduler.pop(WORKER_BATCH_SIZE, skip)
+        for task in superseded_tasks(tasks):
+            task['_superseded'] = True
+        return [(task, load_message_payload(task['message_id'])) for task in tasks]
+
+    async def fan_outs(self):
+        """Run durable fan-out jobs alongside delivery, one at a time"""
+        while True:
+            if not await asyncio.to_thread(run_fan_out_job, self.scheduler.consumer):
+                await asyncio.sleep(WORKER_IDLE_SLEEP)
+
+    async def run(self):
+        fan_outs = asyncio.create_task(self.fan_outs())
+        try:
+            while True:
+                batch = await asyncio.to_thread(self.next_batch, self.take(), self.egress.blocked_projects())
+                if not batch:
+                    await asyncio.sleep(WORKER_IDLE_SLEEP)
+                    continue
+                for task, payload in batch:
+                    if payload and not task.get('_superseded'):
+                        # Take the credential's slot before a global one; a task whose
+                        # credential is paused or at its limit goes back to the queue
+                        # instead of holding a global slot while it waits
+                        limit = self.egress.limit(payload['project_id'], task['platform'])
+                        if not limit.try_acquire():
+                            self.defer(task, limit.pause_remaining() or EGRESS_DEFER_DELAY)
+                            self.done.append(task)
+                            continue
+                    await self.semaphore.acquire()
+                    delivery = asyncio.create_task(self.deliver(task, payload))
+                    self.in_flight.add(delivery)
+                    delivery.add_done_callback(self.in_flight.discard)
+        finally:
+            fan_outs.cancel()
+            await asyncio.gather(*self.in_flight)
+            self.finish(*self.take(force=True))
+            await self.pool.close()
+
+if __name__ == '__main__':
+    if WORKER_METRICS_PORT:
+        start_http_server(int(WORKER_METRICS_PORT))
+    asyncio.run(Worker().run())
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# Share prometheus metrics between worker processes
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='push-api-metrics-'))
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)